@@ -6,6 +6,7 @@ from slicer.ScriptedLoadableModule import *
 from SliceTrackerUtils.configuration import SliceTrackerConfiguration
 from SliceTrackerUtils.constants import SliceTrackerConstants
 from SliceTrackerUtils.session import SliceTrackerSession
+from SliceTrackerUtils.snapshotWriter import SnapshotWriter
 
 from SliceTrackerUtils.steps.base import SliceTrackerStep
 from SliceTrackerUtils.steps.overview import SliceTrackerOverviewStep
@@ -56,6 +57,7 @@ class SliceTrackerWidget(ModuleWidgetMixin, SliceTrackerConstants, ScriptedLoada
     self.session.addEventObserver(self.session.CloseCaseEvent, lambda caller, event: self.cleanup())
     self.session.addEventObserver(SlicerDevelopmentToolboxEvents.NewFileIndexedEvent, self.onNewFileIndexed)
     self.demoMode = str(self.getSetting("Demo_Mode", moduleName=self.moduleName)).lower() == 'true'
+    slicer.app.aboutToQuit.connect(self.onAboutToQuit)
 
   def enter(self):
     if not slicer.dicomDatabase:
@@ -67,15 +69,20 @@ class SliceTrackerWidget(ModuleWidgetMixin, SliceTrackerConstants, ScriptedLoada
     pass
 
   def onReload(self):
+    slicer.app.aboutToQuit.disconnect(self.onAboutToQuit)
     ScriptedLoadableModuleWidget.onReload(self)
 
   @logmethod(logging.DEBUG)
   def cleanup(self):
     ScriptedLoadableModuleWidget.cleanup(self)
+    SnapshotWriter().flush()
     self.patientWatchBox.sourceFile = None
     self.preopWatchBox.sourceFile = None
     self.intraopWatchBox.sourceFile = None
 
+  def onAboutToQuit(self):
+    SnapshotWriter().flush()
+
   def setup(self):
     ScriptedLoadableModuleWidget.setup(self)
 
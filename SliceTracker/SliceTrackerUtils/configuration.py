@@ -56,9 +56,20 @@ class SliceTrackerConfiguration(ModuleWidgetMixin):
     if not self.getSetting("Incoming_DICOM_Port"):
       self.setSetting("Incoming_DICOM_Port", config.get('DICOM', 'Incoming_Port'))
 
+    if not self.getSetting("Series_Completion_Timeout"):
+      self.setSetting("Series_Completion_Timeout", config.get('DICOM', 'Series_Completion_Timeout'))
+
     if not self.getSetting("CASE_NUMBER_OF_DIGITS"):
       self.setSetting("CASE_NUMBER_OF_DIGITS", config.get('General', 'CASE_NUMBER_OF_DIGITS'))
 
+    if not self.getSetting("Loaded_Volume_Cache_Budget_MB"):
+      self.setSetting("Loaded_Volume_Cache_Budget_MB", config.get('General', 'Loaded_Volume_Cache_Budget_MB'))
+
+    for setting, option in [("Volume_Compression", "Volumes"), ("Label_Compression", "Labels"),
+                            ("Transform_Compression", "Transforms")]:
+      if not self.getSetting(setting):
+        self.setSetting(setting, config.get('Compression', option))
+
     self.replaceOldValues()
 
   def replaceOldValues(self):
@@ -69,4 +80,8 @@ class SliceTrackerConfiguration(ModuleWidgetMixin):
 
     for other in ['OTHER_IMAGE', 'Rating_Enabled', 'Maximum_Rating_Score']:
       if self.getSetting(other):
-        self.removeSetting(other)
\ No newline at end of file
+        self.removeSetting(other)
+
+    for setting in ['Volume_Compression', 'Label_Compression', 'Transform_Compression']:
+      if self.getSetting(setting) in ['fast', 'high']:
+        self.setSetting(setting, 'compressed')
\ No newline at end of file
@@ -0,0 +1,271 @@
+import os
+import time
+import logging
+import sqlite3
+import multiprocessing
+
+from dicom.tag import Tag
+from dicom.filereader import read_partial
+
+from SlicerDevelopmentToolboxUtils.exceptions import DICOMValueError
+
+from helpers import mapInThreads
+
+
+class DICOMHeaderRecord(object):
+
+  @property
+  def series(self):
+    return "{}: {}".format(self.seriesNumberText, self.seriesDescription)
+
+  def __init__(self, fileName, seriesNumber, seriesDescription, patientID=None, patientName=None,
+               imagesInAcquisition=None):
+    self.fileName = fileName
+    self.seriesNumberText = seriesNumber
+    self.seriesNumber = int(seriesNumber)
+    self.seriesDescription = seriesDescription
+    self.patientID = patientID
+    self.patientName = patientName
+    self.imagesInAcquisition = int(imagesInAcquisition) if imagesInAcquisition else None
+    self.modifiedTime = None
+    self.fromCache = False
+
+  def getPatientInformation(self):
+    return {
+      "PatientID": self.patientID,
+      "PatientName": self.patientName,
+      "SeriesDescription": self.seriesDescription}
+
+
+class DICOMHeaderReader(object):
+  """ Reads all tags needed by SliceTracker in a single pass which stops before the pixel data """
+
+  TAGS = {
+    "seriesNumber": Tag(0x0020, 0x0011),
+    "seriesDescription": Tag(0x0008, 0x103E),
+    "patientID": Tag(0x0010, 0x0020),
+    "patientName": Tag(0x0010, 0x0010),
+    "imagesInAcquisition": Tag(0x0020, 0x1002)
+  }
+
+  PIXEL_DATA_TAG = Tag(0x7FE0, 0x0010)
+
+  def __init__(self):
+    self._lastTag = min(max(self.TAGS.values()), self.PIXEL_DATA_TAG)
+
+  def _stopWhen(self, tag, VR, length):
+    return tag > self._lastTag or tag == self.PIXEL_DATA_TAG
+
+  def readValues(self, fileName):
+    with open(fileName, 'rb') as f:
+      dataset = read_partial(f, stop_when=self._stopWhen)
+    values = {}
+    for attribute, tag in self.TAGS.iteritems():
+      values[attribute] = str(dataset[tag].value).strip() if tag in dataset else None
+    return values
+
+  def read(self, fileName):
+    try:
+      values = self.readValues(fileName)
+    except Exception as exc:
+      logging.debug(exc)
+      values = {}
+    seriesNumber = values.get("seriesNumber")
+    seriesDescription = values.get("seriesDescription")
+    if not (seriesNumber and seriesDescription):
+      raise DICOMValueError("Missing Attribute(s):\nFile: {}\nseriesNumber: {}\nseriesDescription: {}"
+                            .format(fileName, seriesNumber, seriesDescription))
+    return DICOMHeaderRecord(fileName, seriesNumber, seriesDescription, patientID=values.get("patientID"),
+                             patientName=values.get("patientName"),
+                             imagesInAcquisition=values.get("imagesInAcquisition"))
+
+
+class DICOMHeaderIndex(object):
+  """ Keeps the header records of all indexed intraop DICOM files in memory, each file is read once """
+
+  NUMBER_OF_THREADS = min(multiprocessing.cpu_count(), 8)
+  MINIMUM_FILES_FOR_THREADS = 8
+  POLLING_INTERVAL = 0.05
+
+  def __init__(self, cache=None):
+    self.cache = cache
+    self.reader = DICOMHeaderReader()
+    self.clear()
+
+  def clear(self):
+    self._records = {}
+    self._seriesFiles = {}
+    self._seriesModifiedTimes = {}
+
+  def __contains__(self, fileName):
+    return fileName in self._records
+
+  def __len__(self):
+    return len(self._records)
+
+  def addFile(self, fileName):
+    try:
+      return self._records[fileName]
+    except KeyError:
+      return self.addFiles([fileName])[0]
+
+  def addFiles(self, fileNames, progressCallback=None):
+    """ Returns the records in the given order, headers which are not known yet are read on worker threads """
+    records = {}
+    fileStats = {}
+    filesToRead = []
+    for fileName in set(fileNames):
+      if fileName in self._records:
+        continue
+      record = None
+      fileStats[fileName] = os.stat(fileName)
+      if self.cache:
+        record = self.cache.getRecord(fileName, fileStats[fileName].st_size, fileStats[fileName].st_mtime)
+      if record:
+        records[fileName] = record
+      else:
+        filesToRead.append(fileName)
+
+    for fileName, record in self._readRecords(filesToRead, progressCallback).iteritems():
+      record.modifiedTime = fileStats[fileName].st_mtime
+      if self.cache:
+        self.cache.addRecord(record, fileStats[fileName].st_size, fileStats[fileName].st_mtime)
+      records[fileName] = record
+
+    for fileName in fileNames:
+      if fileName in records and fileName not in self._records:
+        self._insertRecord(records[fileName])
+    return [self._records[fileName] for fileName in fileNames]
+
+  def _insertRecord(self, record):
+    self._records[record.fileName] = record
+    self._seriesFiles.setdefault(record.series, []).append(record.fileName)
+    self._seriesModifiedTimes[record.series] = max(self._seriesModifiedTimes.get(record.series, 0),
+                                                   record.modifiedTime)
+
+  def _readRecords(self, fileNames, progressCallback=None):
+    if len(fileNames) < self.MINIMUM_FILES_FOR_THREADS:
+      records = {}
+      for index, fileName in enumerate(fileNames, start=1):
+        records[fileName] = self.readRecord(fileName)
+        if progressCallback:
+          progressCallback(index, len(fileNames))
+      return records
+    return self._readRecordsInParallel(fileNames, progressCallback)
+
+  def _readRecordsInParallel(self, fileNames, progressCallback=None):
+    records = {}
+    for fileName, record, excInfo in mapInThreads(self.readRecord, fileNames, self.NUMBER_OF_THREADS,
+                                                  self.POLLING_INTERVAL, progressCallback):
+      if excInfo:
+        raise excInfo[0], excInfo[1], excInfo[2]
+      records[fileName] = record
+    return records
+
+  def getRecord(self, fileName):
+    return self.addFile(fileName)
+
+  def readRecord(self, fileName):
+    return self.reader.read(fileName)
+
+  def getSeries(self):
+    return self._seriesFiles.keys()
+
+  def getFilesForSeries(self, series):
+    return list(self._seriesFiles.get(series, []))
+
+  def getExpectedNumberOfFiles(self, series):
+    record = self.getFirstRecordForSeries(series)
+    return record.imagesInAcquisition if record else None
+
+  def isSeriesComplete(self, series, stableCountTimeout):
+    """ Complete by ImagesInAcquisition (0020,1002) or once no file changed for stableCountTimeout seconds """
+    if series not in self._seriesFiles:
+      return False
+    expected = self.getExpectedNumberOfFiles(series)
+    if expected and len(self._seriesFiles[series]) >= expected:
+      return True
+    return time.time() - self._seriesModifiedTimes[series] >= stableCountTimeout
+
+  def getFirstRecordForSeries(self, series):
+    files = self._seriesFiles.get(series)
+    return self._records[files[0]] if files else None
+
+  def removeSeries(self, series):
+    self._seriesModifiedTimes.pop(series, None)
+    for fileName in self._seriesFiles.pop(series, []):
+      logging.debug("removing {} from DICOM header index".format(fileName))
+      del self._records[fileName]
+      if self.cache:
+        self.cache.removeRecord(fileName)
+    if self.cache:
+      self.cache.commit()
+
+
+class DICOMHeaderCache(object):
+  """ Persists header records keyed by relative path, size and modification time in a SQLite database """
+
+  VERSION = 2
+
+  def __init__(self, databaseFile, rootDirectory):
+    self.databaseFile = databaseFile
+    self.rootDirectory = rootDirectory
+    self.connection = sqlite3.connect(databaseFile)
+    self.connection.text_factory = str
+    self._entries = {}
+    self._createTables()
+    self._readEntries()
+
+  def _createTables(self):
+    cursor = self.connection.cursor()
+    cursor.execute("CREATE TABLE IF NOT EXISTS info (version INTEGER)")
+    row = cursor.execute("SELECT version FROM info").fetchone()
+    if row is None or row[0] != self.VERSION:
+      logging.debug("Creating DICOM header cache %s" % self.databaseFile)
+      cursor.execute("DROP TABLE IF EXISTS headers")
+      cursor.execute("DELETE FROM info")
+      cursor.execute("INSERT INTO info VALUES (?)", (self.VERSION,))
+    cursor.execute("CREATE TABLE IF NOT EXISTS headers (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, "
+                   "seriesNumber TEXT, seriesDescription TEXT, patientID TEXT, patientName TEXT, "
+                   "imagesInAcquisition INTEGER)")
+    self.connection.commit()
+
+  def _readEntries(self):
+    for row in self.connection.execute("SELECT * FROM headers"):
+      self._entries[row[0]] = row[1:]
+
+  def _getKey(self, fileName):
+    return os.path.relpath(fileName, self.rootDirectory)
+
+  def getRecord(self, fileName, size, mtime):
+    try:
+      cachedSize, cachedMTime, seriesNumber, seriesDescription, patientID, patientName, imagesInAcquisition = \
+        self._entries[self._getKey(fileName)]
+    except KeyError:
+      return None
+    if cachedSize != size or cachedMTime != mtime:
+      return None
+    record = DICOMHeaderRecord(fileName, seriesNumber, seriesDescription, patientID=patientID, patientName=patientName,
+                               imagesInAcquisition=imagesInAcquisition)
+    record.modifiedTime = cachedMTime
+    record.fromCache = True
+    return record
+
+  def addRecord(self, record, size, mtime):
+    key = self._getKey(record.fileName)
+    entry = (size, mtime, record.seriesNumberText, record.seriesDescription, record.patientID,
+             record.patientName, record.imagesInAcquisition)
+    self._entries[key] = entry
+    self.connection.execute("INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (key,) + entry)
+
+  def removeRecord(self, fileName):
+    key = self._getKey(fileName)
+    self._entries.pop(key, None)
+    self.connection.execute("DELETE FROM headers WHERE path=?", (key,))
+
+  def commit(self):
+    self.connection.commit()
+
+  def close(self):
+    self.connection.commit()
+    self.connection.close()
@@ -1,9 +1,14 @@
 import logging
 import os
+import sys
 import datetime
+import functools
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import qt
 import vtk
 import re
+import bisect
 import slicer
 
 from constants import SliceTrackerConstants as constants
@@ -17,6 +22,54 @@ from SlicerDevelopmentToolboxUtils.metaclasses import Singleton
 from SlicerDevelopmentToolboxUtils.icons import Icons
 
 
+MOVEFILE_REPLACE_EXISTING = 0x1
+MOVEFILE_WRITE_THROUGH = 0x8
+
+
+def replaceFile(source, destination):
+  """ Replaces destination by source atomically, also on Windows where os.rename does not replace existing files """
+  if hasattr(os, "replace"):
+    os.replace(source, destination)
+  elif os.name == "nt":
+    import ctypes
+    if not ctypes.windll.kernel32.MoveFileExW(unicode(source), unicode(destination),
+                                              MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH):
+      raise ctypes.WinError()
+  else:
+    os.rename(source, destination)
+
+
+def _callCapturingException(function, argument):
+  try:
+    return argument, function(argument), None
+  except Exception:
+    return argument, None, sys.exc_info()
+
+
+def mapInThreads(function, arguments, numberOfThreads, pollingInterval=0.05, progressCallback=None):
+  """ Yields (argument, result, excInfo) in order of completion, excInfo is the sys.exc_info() of a failed call """
+  arguments = list(arguments)
+  if not arguments:
+    return
+  finished = 0
+  pool = ThreadPool(min(numberOfThreads, len(arguments)))
+  try:
+    results = pool.imap_unordered(functools.partial(_callCapturingException, function), arguments)
+    while finished < len(arguments):
+      try:
+        result = results.next(timeout=pollingInterval)
+      except multiprocessing.TimeoutError:
+        pass
+      else:
+        finished += 1
+        yield result
+      if progressCallback:
+        progressCallback(finished, len(arguments))
+  finally:
+    pool.terminate()
+    pool.join()
+
+
 class NewCaseSelectionNameWidget(qt.QMessageBox, ModuleWidgetMixin):
 
   PREFIX = "Case"
@@ -170,6 +223,91 @@ class SeriesTypeManager(LogicBase):
     return self.getSeriesType(series) == seriesType
 
 
+class SeriesRecord(object):
+
+  def __init__(self, name):
+    number, description = name.split(": ", 1)
+    self.name = name
+    self.number = int(number)
+    self.description = description
+
+
+class SeriesRegistry(object):
+  """ Iterates the received series names in ascending series number order """
+
+  def __init__(self):
+    self.seriesTypeManager = SeriesTypeManager()
+    self.clear()
+
+  def clear(self):
+    self._records = []
+    self._numbers = []
+    self._byName = {}
+    self._byNumber = {}
+    self._byType = {}
+
+  def __iter__(self):
+    return iter([record.name for record in self._records])
+
+  def __reversed__(self):
+    return iter([record.name for record in reversed(self._records)])
+
+  def __len__(self):
+    return len(self._records)
+
+  def __contains__(self, series):
+    return series in self._byName
+
+  def __getitem__(self, index):
+    return self._records[index].name
+
+  def add(self, series):
+    if series in self._byName:
+      return self._byName[series]
+    record = SeriesRecord(series)
+    index = bisect.bisect_right(self._numbers, record.number)
+    self._records.insert(index, record)
+    self._numbers.insert(index, record.number)
+    self._byName[series] = record
+    self._byNumber.setdefault(record.number, []).append(record)
+    self._byType.setdefault(self.seriesTypeManager.getSeriesType(series), []).append(record)
+    return record
+
+  def remove(self, series):
+    record = self._byName.pop(series)
+    index = self._records.index(record)
+    del self._records[index]
+    del self._numbers[index]
+    self._byNumber[record.number].remove(record)
+    if not self._byNumber[record.number]:
+      del self._byNumber[record.number]
+    for records in self._byType.values():
+      if record in records:
+        records.remove(record)
+
+  def getRecord(self, series):
+    return self._byName[series]
+
+  def getSeriesByNumber(self, seriesNumber):
+    return [record.name for record in self._byNumber.get(seriesNumber, [])]
+
+  def getSeriesByType(self, seriesType):
+    return [record.name for record in sorted(self._byType.get(seriesType, []), key=lambda r: r.number)]
+
+  def getMostRecentSeriesForTypeSubstring(self, substring):
+    records = [record for seriesType, records in self._byType.iteritems() if substring in seriesType
+               for record in records]
+    return max(records, key=lambda r: r.number).name if records else None
+
+  def getRecordsBefore(self, seriesNumber):
+    return self._records[:bisect.bisect_left(self._numbers, seriesNumber)]
+
+  def updateSeriesTypes(self):
+    self._byType = {}
+    for record in self._records:
+      self._byType.setdefault(self.seriesTypeManager.getSeriesType(record.name), []).append(record)
+
+
 class IncomingDataMessageBox(ExtendedQMessageBox):
 
   def __init__(self, parent=None):
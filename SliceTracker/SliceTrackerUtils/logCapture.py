@@ -0,0 +1,63 @@
+import os, json, logging
+
+from helpers import replaceFile
+
+
+class IncrementalLogCapture(object):
+  """ Appends only the bytes written to a log file since the previous capture to its copy """
+
+  CHUNK_SIZE = 1024 * 1024
+  STATE_FILE_EXTENSION = ".capture"
+
+  @classmethod
+  def getStateFileName(cls, destination):
+    return destination + cls.STATE_FILE_EXTENSION
+
+  @classmethod
+  def readState(cls, destination):
+    """ Returns the identity of the captured source and the offset up to which it was captured or None """
+    try:
+      with open(cls.getStateFileName(destination)) as f:
+        state = json.load(f)
+      return (state["device"], state["inode"]), state["offset"]
+    except (IOError, ValueError, KeyError, TypeError) as exc:
+      if os.path.exists(cls.getStateFileName(destination)):
+        logging.warning("Ignoring unreadable log capture state of %s: %s" % (destination, exc))
+      return None
+
+  @classmethod
+  def writeState(cls, destination, identity, offset):
+    stateFileName = cls.getStateFileName(destination)
+    with open(stateFileName + ".partial", 'w') as f:
+      json.dump({"device": identity[0], "inode": identity[1], "offset": offset}, f)
+    replaceFile(stateFileName + ".partial", stateFileName)
+
+  @classmethod
+  def capture(cls, source, destination):
+    """ Appends the new content of source to destination and returns the number of bytes appended """
+    stat = os.stat(source)
+    identity = (stat.st_dev, stat.st_ino)
+    state = cls.readState(destination)
+    if not os.path.exists(destination):
+      offset = 0
+    elif state is None:
+      # captured before the state was persisted: the destination is a copy of the log
+      offset = os.path.getsize(destination)
+    else:
+      # a rotated (different inode) log is captured from its start again
+      offset = state[1] if tuple(state[0]) == identity else 0
+    if offset > stat.st_size:
+      # truncated
+      offset = 0
+
+    appended = 0
+    with open(source, 'rb') as sourceFile, open(destination, 'ab') as destinationFile:
+      sourceFile.seek(offset)
+      while True:
+        chunk = sourceFile.read(cls.CHUNK_SIZE)
+        if not chunk:
+          break
+        destinationFile.write(chunk)
+        appended += len(chunk)
+    cls.writeState(destination, identity, offset + appended)
+    return appended
@@ -0,0 +1,72 @@
+import os
+import logging
+import multiprocessing
+from collections import OrderedDict
+
+import vtk
+import slicer
+
+from helpers import mapInThreads
+
+
+class ParallelVolumeReader(object):
+  """ Decodes volume files on worker threads, MRML nodes are only created on the calling (main) thread """
+
+  NUMBER_OF_THREADS = min(multiprocessing.cpu_count(), 4)
+  POLLING_INTERVAL = 0.05
+
+  @staticmethod
+  def readImageData(fileName):
+    return ParallelVolumeReader.readSeriesImageData([fileName])
+
+  @staticmethod
+  def readSeriesImageData(fileNames):
+    """ Reads one volume from all fileNames (e.g. the DICOM files of a series) without touching the MRML scene """
+    reader = slicer.vtkITKArchetypeImageSeriesScalarReader()
+    reader.SetArchetype(fileNames[0])
+    reader.SetSingleFile(len(fileNames) == 1)
+    if len(fileNames) > 1:
+      for fileName in fileNames:
+        reader.AddFileName(fileName)
+    reader.SetOutputScalarTypeToNative()
+    reader.SetDesiredCoordinateOrientationToNative()
+    reader.SetUseNativeOriginOn()
+    reader.Update()
+    if reader.GetErrorCode() or not reader.GetOutput() or not reader.GetOutput().GetPointData().GetScalars():
+      raise IOError("Reading %s failed" % fileNames[0])
+    imageData = vtk.vtkImageData()
+    imageData.DeepCopy(reader.GetOutput())
+    # the geometry is carried by the volume node
+    imageData.SetSpacing(1, 1, 1)
+    imageData.SetOrigin(0, 0, 0)
+    rasToIJK = vtk.vtkMatrix4x4()
+    rasToIJK.DeepCopy(reader.GetRasToIjkMatrix())
+    return imageData, rasToIJK
+
+  @staticmethod
+  def createVolumeNode(fileName, imageData, rasToIJK, isLabel=False):
+    volume = slicer.vtkMRMLLabelMapVolumeNode() if isLabel else slicer.vtkMRMLScalarVolumeNode()
+    volume.SetName(os.path.splitext(os.path.basename(fileName))[0])
+    volume.SetRASToIJKMatrix(rasToIJK)
+    volume.SetAndObserveImageData(imageData)
+    slicer.mrmlScene.AddNode(volume)
+    volume.CreateDefaultDisplayNodes()
+    storageNode = volume.CreateDefaultStorageNode()
+    storageNode.SetFileName(fileName)
+    slicer.mrmlScene.AddNode(storageNode)
+    volume.SetAndObserveStorageNodeID(storageNode.GetID())
+    return volume
+
+  def read(self, fileNames, labelFileNames=None, progressCallback=None):
+    """ Returns the volume nodes by file name, files which could not be read are left out """
+    labelFileNames = set(labelFileNames or [])
+    fileNames = OrderedDict.fromkeys(list(fileNames) + list(labelFileNames)).keys()
+    volumes = {}
+    for fileName, result, excInfo in mapInThreads(self.readImageData, fileNames, self.NUMBER_OF_THREADS,
+                                                  self.POLLING_INTERVAL, progressCallback):
+      if excInfo:
+        logging.warning("Could not read %s in parallel: %s" % (fileName, excInfo[1]))
+      else:
+        imageData, rasToIJK = result
+        volumes[fileName] = self.createVolumeNode(fileName, imageData, rasToIJK, fileName in labelFileNames)
+    return volumes
@@ -0,0 +1,237 @@
+import sys, getopt, os, json
+import time
+from collections import OrderedDict
+from dicom.tag import Tag
+from dicom.filereader import read_partial
+
+from watch import StoreSCUSender
+from resultsJournal import ResultsJournal
+
+
+class RecordedSeries(object):
+
+  def __init__(self, seriesInstanceUID, seriesNumber, seriesDescription):
+    self.seriesInstanceUID = seriesInstanceUID
+    self.seriesNumber = seriesNumber
+    self.seriesDescription = seriesDescription
+    self.files = []
+    self.onset = None
+
+
+class RecordedCase(object):
+  """ Series are ordered by SeriesDate/SeriesTime, falling back to the earliest modification time of their files """
+
+  TAGS = {
+    "seriesDate": Tag(0x0008, 0x0021),
+    "seriesTime": Tag(0x0008, 0x0031),
+    "seriesDescription": Tag(0x0008, 0x103E),
+    "seriesInstanceUID": Tag(0x0020, 0x000E),
+    "seriesNumber": Tag(0x0020, 0x0011)
+  }
+
+  def __init__(self, directory):
+    self.directory = directory
+    self.series = self.readSeries()
+
+  def readHeader(self, fileName):
+    lastTag = max(self.TAGS.values())
+    with open(fileName, 'rb') as f:
+      dataset = read_partial(f, stop_when=lambda tag, VR, length: tag > lastTag)
+    return dict((attribute, str(dataset[tag].value).strip() if tag in dataset else None)
+                for attribute, tag in self.TAGS.iteritems())
+
+  def readSeries(self):
+    series = OrderedDict()
+    for root, _, fileNames in os.walk(self.directory):
+      for fileName in sorted(fileNames):
+        fileName = os.path.join(root, fileName)
+        try:
+          header = self.readHeader(fileName)
+        except Exception:
+          continue
+        if not header["seriesInstanceUID"]:
+          continue
+        current = series.get(header["seriesInstanceUID"])
+        if not current:
+          current = series[header["seriesInstanceUID"]] = RecordedSeries(header["seriesInstanceUID"],
+                                                                         int(header["seriesNumber"] or 0),
+                                                                         header["seriesDescription"])
+        current.files.append(fileName)
+        onset = self.getOnset(header, fileName)
+        current.onset = onset if current.onset is None else min(current.onset, onset)
+    return sorted(series.values(), key=lambda s: (s.onset, s.seriesNumber))
+
+  @staticmethod
+  def getOnset(header, fileName):
+    if header["seriesDate"] and header["seriesTime"]:
+      try:
+        seriesTime = header["seriesTime"].split(".")
+        onset = time.mktime(time.strptime(header["seriesDate"] + seriesTime[0][:6], "%Y%m%d%H%M%S"))
+        return onset + (float("0." + seriesTime[1]) if len(seriesTime) > 1 and seriesTime[1] else 0)
+      except ValueError:
+        pass
+    return os.path.getmtime(fileName)
+
+
+class ScannerReplay(object):
+  """ Sends the series of a recorded case with their original timing divided by speed, or back to back in burst mode """
+
+  def __init__(self, case, sender, speed=1.0, burst=False, burstInterval=0):
+    self.case = case
+    self.sender = sender
+    self.speed = speed
+    self.burst = burst
+    self.burstInterval = burstInterval
+
+  def getSchedule(self):
+    if not len(self.case.series):
+      return []
+    if self.burst:
+      return [(index * self.burstInterval, series) for index, series in enumerate(self.case.series)]
+    firstOnset = self.case.series[0].onset
+    return [((series.onset - firstOnset) / self.speed, series) for series in self.case.series]
+
+  def replay(self):
+    report = {
+      "directory": self.case.directory,
+      "speed": self.speed,
+      "burst": self.burst,
+      "startTime": time.time(),
+      "series": []
+    }
+    for offset, series in self.getSchedule():
+      delay = report["startTime"] + offset - time.time()
+      if delay > 0:
+        time.sleep(delay)
+      print "Sending series %d: %s (%d files)" % (series.seriesNumber, series.seriesDescription, len(series.files))
+      sendStart = time.time()
+      success = self.sender.send(series.files)
+      sendEnd = time.time()
+      report["series"].append({
+        "seriesNumber": series.seriesNumber,
+        "seriesDescription": series.seriesDescription,
+        "seriesInstanceUID": series.seriesInstanceUID,
+        "files": len(series.files),
+        "scheduledOffset": offset,
+        "sendStart": sendStart,
+        "sendEnd": sendEnd,
+        "filesPerSecond": len(series.files) / (sendEnd - sendStart) if sendEnd > sendStart else None,
+        "success": success
+      })
+    report["endTime"] = time.time()
+    return report
+
+
+SLICETRACKER_TIME_FORMATS = ["%Y-%m-%d %H:%M:%S", "%Y-%m-%d_%H:%M:%S", "%Y%m%d%H%M%S"]
+
+
+def parseSliceTrackerTime(timestamp):
+  for timeFormat in SLICETRACKER_TIME_FORMATS:
+    try:
+      return time.mktime(time.strptime(timestamp, timeFormat))
+    except (ValueError, TypeError):
+      pass
+  return None
+
+
+def computeLatencies(report, resultsFile):
+  """ Seconds from sending the last slice of a series until it was received and until its registration finished """
+  data = ResultsJournal.read(resultsFile)
+  results = {}
+  for result in data.get("results", []):
+    results.setdefault(int(result["name"].split(":")[0]), []).append(result)
+
+  def getLatency(timestamp, sendEnd):
+    seconds = parseSliceTrackerTime(timestamp) if timestamp else None
+    return seconds - sendEnd if seconds is not None else None
+
+  latencies = []
+  for series in report["series"]:
+    seriesResults = results.get(series["seriesNumber"], [])
+    receivedTime = seriesResults[0]["series"]["receivedTime"] if seriesResults else None
+    registrationEnds = [r["registration"]["endTime"] for r in seriesResults if r.get("registration")]
+    latencies.append({
+      "seriesNumber": series["seriesNumber"],
+      "seriesDescription": series["seriesDescription"],
+      "receivedLatency": getLatency(receivedTime, series["sendEnd"]),
+      "targetsDisplayedLatency": getLatency(registrationEnds[-1], series["sendEnd"]) if registrationEnds else None
+    })
+  return latencies
+
+
+def main(argv):
+   caseDirectory = ''
+   host = 'localhost'
+   port = '11112'
+   calledAETitle = "ANY-SCP"
+   callingAETitle = "STORESCU"
+   speed = 1.0
+   burst = False
+   burstInterval = 0
+   outputFile = None
+   resultsFile = None
+   reportFile = None
+   usage = 'replay.py -d <recorded case directory> -h <host> -p <port> [--aec <called AE title>] ' \
+           '[--aet <calling AE title>] [--speed <factor> | --burst [--burst-interval <seconds>]] -o <report.json>\n' \
+           'replay.py --latency <results.json> -r <report.json> [-o <latencies.json>]'
+   try:
+      opts, args = getopt.getopt(argv,"d:h:p:o:r:?",["help","directory=","host=","port=","aec=","aet=","speed=",
+                                                       "burst","burst-interval=","output=","latency=","report="])
+   except getopt.GetoptError:
+      print usage
+      sys.exit(2)
+   for opt, arg in opts:
+      if opt in ("-?", "--help"):
+         print usage
+         sys.exit()
+      elif opt in ("-d", "--directory"):
+         caseDirectory = arg
+      elif opt in ("-h", "--host"):
+         host = arg
+      elif opt in ("-p", "--port"):
+         port = arg
+      elif opt == "--aec":
+         calledAETitle = arg
+      elif opt == "--aet":
+         callingAETitle = arg
+      elif opt == "--speed":
+         speed = float(arg)
+      elif opt == "--burst":
+         burst = True
+      elif opt == "--burst-interval":
+         burstInterval = float(arg)
+      elif opt in ("-o", "--output"):
+         outputFile = arg
+      elif opt == "--latency":
+         resultsFile = arg
+      elif opt in ("-r", "--report"):
+         reportFile = arg
+
+   if resultsFile and reportFile:
+     with open(reportFile) as f:
+       output = computeLatencies(json.load(f), resultsFile)
+   elif caseDirectory:
+     case = RecordedCase(caseDirectory)
+     print 'Found %d series in %s' % (len(case.series), caseDirectory)
+     sender = StoreSCUSender(host, port, calledAETitle=calledAETitle, callingAETitle=callingAETitle)
+     output = ScannerReplay(case, sender, speed=speed, burst=burst, burstInterval=burstInterval).replay()
+   else:
+     print usage
+     sys.exit(2)
+
+   output = json.dumps(output, indent=2)
+   print output
+   if outputFile:
+     with open(outputFile, 'w') as f:
+       f.write(output)
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
+
+
+#replay with original timing 10 times faster:
+#  $ python replay.py -d <case>/DICOM/Intraop -h localhost -p 11112 --speed 10 -o report.json
+#stress with back to back series:
+#  $ python replay.py -d <case>/DICOM/Intraop -h localhost -p 11112 --burst -o report.json
+#latencies after the case was saved:
+#  $ python replay.py --latency <case>/SliceTrackerOutputs/results.json -r report.json
@@ -0,0 +1,135 @@
+import os, json, logging
+from collections import OrderedDict
+
+from helpers import replaceFile
+
+
+class ResultsJournal(object):
+  """ Keeps results.json up to date by appending the changes of every save to a JSON lines journal """
+
+  COMPACTION_INTERVAL = 20
+
+  @staticmethod
+  def getJournalFileName(resultsFile):
+    return os.path.splitext(resultsFile)[0] + ".journal"
+
+  @staticmethod
+  def read(resultsFile):
+    """ Returns the content of results.json with all entries of its journal applied """
+    return ResultsJournal._read(resultsFile)[0]
+
+  @staticmethod
+  def _read(resultsFile):
+    data = {"results": []}
+    if os.path.exists(resultsFile):
+      with open(resultsFile) as f:
+        data = json.load(f)
+    numberOfEntries = 0
+    torn = False
+    journalFile = ResultsJournal.getJournalFileName(resultsFile)
+    if os.path.exists(journalFile):
+      with open(journalFile) as f:
+        for line in f:
+          try:
+            entry = json.loads(line)
+          except ValueError:
+            # a crash while appending leaves a torn last line
+            logging.warning("Ignoring incomplete entry at the end of %s" % journalFile)
+            torn = True
+            break
+          ResultsJournal.applyEntry(data, entry)
+          numberOfEntries += 1
+    return data, numberOfEntries, torn
+
+  @staticmethod
+  def applyEntry(data, entry):
+    for key, value in entry.get("set", {}).iteritems():
+      data[key] = value
+    for key in entry.get("unset", []):
+      data.pop(key, None)
+    results = OrderedDict((result["name"], result) for result in data.get("results", []))
+    for name in entry.get("removedResults", []):
+      results.pop(name, None)
+    for result in entry.get("results", []):
+      results[result["name"]] = result
+    data["results"] = sorted(results.values(), key=lambda r: int(r["name"].split(": ")[0]))
+
+  def __init__(self, resultsFile, writer):
+    self.resultsFile = resultsFile
+    self.journalFile = self.getJournalFileName(resultsFile)
+    self.writer = writer
+    self._numberOfEntries = 0
+    self._written = None
+
+  def load(self):
+    data, self._numberOfEntries, torn = self._read(self.resultsFile)
+    # nothing must be appended after an incomplete entry, the next write compacts instead
+    self._written = self._serialize(data) if not torn else None
+    return data
+
+  @staticmethod
+  def _serialize(data):
+    serialized = {"results": OrderedDict(), "keys": {}}
+    for key, value in data.iteritems():
+      if key == "results":
+        for result in value:
+          serialized["results"][result["name"]] = json.dumps(result, sort_keys=True)
+      else:
+        serialized["keys"][key] = json.dumps(value, sort_keys=True)
+    return serialized
+
+  def getChangedEntry(self, serialized):
+    entry = {}
+    written = self._written
+    changedKeys = [k for k, v in serialized["keys"].iteritems() if written["keys"].get(k) != v]
+    if changedKeys:
+      entry["set"] = dict((k, json.loads(serialized["keys"][k])) for k in changedKeys)
+    unset = [k for k in written["keys"].keys() if k not in serialized["keys"]]
+    if unset:
+      entry["unset"] = unset
+    changedResults = [n for n, v in serialized["results"].iteritems() if written["results"].get(n) != v]
+    if changedResults:
+      entry["results"] = [json.loads(serialized["results"][n]) for n in changedResults]
+    removedResults = [n for n in written["results"].keys() if n not in serialized["results"]]
+    if removedResults:
+      entry["removedResults"] = removedResults
+    return entry
+
+  def write(self, data, compact=False):
+    """ Appends the changes of data since the last write to the journal or compacts it into results.json """
+    serialized = self._serialize(data)
+    if compact or self._written is None or self._numberOfEntries + 1 >= self.COMPACTION_INTERVAL:
+      self.writer.enqueue(self.resultsFile, self._compact, (json.dumps(data, indent=2), self.resultsFile,
+                                                            self.journalFile), self.onWriteFailed)
+      self._numberOfEntries = 0
+    else:
+      entry = self.getChangedEntry(serialized)
+      if not entry:
+        return
+      self.writer.enqueue(self.journalFile, self._append, (json.dumps(entry) + "\n", self.journalFile),
+                          self.onWriteFailed)
+      self._numberOfEntries += 1
+    self._written = serialized
+
+  def onWriteFailed(self, fileName):
+    # the next write rewrites everything
+    self._written = None
+
+  @staticmethod
+  def _append(text, journalFile):
+    with open(journalFile, 'a') as f:
+      f.write(text)
+      f.flush()
+      os.fsync(f.fileno())
+
+  @staticmethod
+  def _compact(text, resultsFile, journalFile):
+    temporaryFileName = resultsFile + ".partial"
+    with open(temporaryFileName, 'w') as f:
+      f.write(text)
+      f.flush()
+      os.fsync(f.fileno())
+    replaceFile(temporaryFileName, resultsFile)
+    # replaying the journal on top of the compacted results is idempotent if truncating it gets interrupted
+    if os.path.exists(journalFile):
+      open(journalFile, 'w').close()
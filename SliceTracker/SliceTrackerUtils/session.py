@@ -1,18 +1,23 @@
-import os, logging
+import os, logging, sqlite3
 import vtk, ctk, ast
 import qt
+from multiprocessing.pool import ThreadPool
 
 import slicer
 from sessionData import SessionData, RegistrationResult, RegistrationTypeData
 from constants import SliceTrackerConstants
-from helpers import SeriesTypeManager
+from helpers import SeriesTypeManager, SeriesRegistry
+from dicomHeaderIndex import DICOMHeaderIndex, DICOMHeaderCache
+from volumeCache import LoadedVolumeCache
+from parallelVolumeReader import ParallelVolumeReader
+from snapshotWriter import SnapshotWriter
 from preopHandler import PreopDataHandler
 
-from SlicerDevelopmentToolboxUtils.constants import DICOMTAGS, STYLE
+from SlicerDevelopmentToolboxUtils.constants import STYLE
 from SlicerDevelopmentToolboxUtils.events import SlicerDevelopmentToolboxEvents
 from SlicerDevelopmentToolboxUtils.helpers import SmartDICOMReceiver
 from SlicerDevelopmentToolboxUtils.mixins import ModuleWidgetMixin
-from SlicerDevelopmentToolboxUtils.exceptions import DICOMValueError, UnknownSeriesError
+from SlicerDevelopmentToolboxUtils.exceptions import UnknownSeriesError
 from SlicerDevelopmentToolboxUtils.widgets import IncomingDataWindow, CustomStatusProgressbar
 from SlicerDevelopmentToolboxUtils.widgets import RadioButtonChoiceMessageBox
 from SlicerDevelopmentToolboxUtils.decorators import singleton, onExceptionReturnFalse
@@ -49,6 +54,10 @@ class SliceTrackerSession(StepBasedSession):
 
   MODULE_NAME = SliceTrackerConstants.MODULE_NAME
 
+  PREFETCH_INTERVAL = 0
+  PREFETCH_POLLING_INTERVAL = 50
+  PREFETCH_BUSY_RETRY_INTERVAL = 1000
+
   @property
   def preprocessedDirectory(self):
     return os.path.join(self.directory, "mpReviewPreprocessed") if self.directory else None
@@ -61,6 +70,10 @@ class SliceTrackerSession(StepBasedSession):
   def intraopDICOMDirectory(self):
     return os.path.join(self.directory, "DICOM", "Intraop") if self.directory else None
 
+  @property
+  def intraopDICOMHeaderCacheFile(self):
+    return os.path.join(self.directory, "DICOM", "IntraopHeaderCache.db") if self.directory else None
+
   @property
   def outputDirectory(self):
     return os.path.join(self.directory, "SliceTrackerOutputs")
@@ -102,7 +115,8 @@ class SliceTrackerSession(StepBasedSession):
     if self.currentResult and self.currentResult.name == series:
       return
     if self.currentResult is not None:
-      self.currentResult.removeEventObservers()
+      for event in RegistrationResult.StatusEvents.values():
+        self.currentResult.removeEventObserver(event, self.onRegistrationResultStatusChanged)
     self._currentResult = series
     if self.currentResult:
       for event in RegistrationResult.StatusEvents.values():
@@ -195,11 +209,23 @@ class SliceTrackerSession(StepBasedSession):
     self.registrationLogic = SliceTrackerRegistrationLogic()
     self.seriesTypeManager = SeriesTypeManager()
     self.seriesTypeManager.addEventObserver(self.seriesTypeManager.SeriesTypeManuallyAssignedEvent,
-                                            lambda caller, event: self.invokeEvent(self.SeriesTypeManuallyAssignedEvent))
+                                            self.onSeriesTypeManuallyAssigned)
+    self.savingSynchronously = False
+    SnapshotWriter().addEventObserver(SnapshotWriter.SnapshotWriteFailedEvent, self.onSnapshotWriteFailed)
     self.resetAndInitializeMembers()
 
+  def onSeriesTypeManuallyAssigned(self, caller, event):
+    self.seriesList.updateSeriesTypes()
+    self.invokeEvent(self.SeriesTypeManuallyAssignedEvent)
+
+  @vtk.calldata_type(vtk.VTK_STRING)
+  def onSnapshotWriteFailed(self, caller, event, callData):
+    if not self.savingSynchronously:
+      slicer.util.warningDisplay("The following data failed to saved:\n %s" % [callData], windowTitle="SliceTracker")
+
   def resetAndInitializeMembers(self):
     self._busy = False
+    self.closeDICOMHeaderCache()
     self.seriesTypeManager.clear()
     self.initializeColorNodes()
     self.directory = None
@@ -208,10 +234,17 @@ class SliceTrackerSession(StepBasedSession):
     self.trainingMode = False
     self.resetPreopDICOMReceiver()
     self.resetIntraopDICOMReceiver()
+    self.headerIndex = DICOMHeaderIndex()
     self.loadableList = {}
-    self.seriesList = []
+    self.seriesList = SeriesRegistry()
+    self.incompleteSeries = []
+    self.referencePatientSeries = None
+    self.referencePatientInformation = None
     self.seriesTimeStamps = dict()
-    self.alreadyLoadedSeries = {}
+    cacheBudget = int(self.getSetting("Loaded_Volume_Cache_Budget_MB") or 2048) * 1024 * 1024
+    self.alreadyLoadedSeries = LoadedVolumeCache(cacheBudget, isPinned=self.isLoadedVolumePinned)
+    self.resetSeriesCompletionTimer()
+    self.resetPrefetchTimer()
     self._currentResult = None
     self._currentSeries = None
     self.retryMode = False
@@ -278,14 +311,18 @@ class SliceTrackerSession(StepBasedSession):
       return
     message = None
     if save:
-      success, failedFileNames = self.data.close(self.outputDirectory)
+      self.savingSynchronously = True
+      try:
+        success, failedFileNames = self.data.close(self.outputDirectory)
+      finally:
+        self.savingSynchronously = False
       message = "Case data has been saved successfully." if success else \
         "The following data failed to saved:\n %s" % failedFileNames
     self.resetAndInitializeMembers()
     self.invokeEvent(self.CloseCaseEvent, str(message))
 
   def save(self):
-    success, failedFileNames = self.data.save(self.outputDirectory)
+    success, failedFileNames = self.data.save(self.outputDirectory, asynchronous=True)
     return success and not len(failedFileNames), "The following data failed to saved:\n %s" % failedFileNames
 
   def complete(self):
@@ -381,10 +418,25 @@ class SliceTrackerSession(StepBasedSession):
       self.intraopDICOMReceiver.start(not (self.trainingMode or self.data.completed))
     else:
       self.invokeEvent(SlicerDevelopmentToolboxEvents.StoppedEvent)
+    self.openDICOMHeaderCache()
     self.importDICOMSeries(self.getFileList(self.intraopDICOMDirectory))
     if self.intraopDICOMReceiver:
       self.intraopDICOMReceiver.forceStatusChangeEventUpdate()
 
+  def openDICOMHeaderCache(self):
+    if self.headerIndex.cache:
+      return
+    try:
+      self.headerIndex.cache = DICOMHeaderCache(self.intraopDICOMHeaderCacheFile, self.intraopDICOMDirectory)
+    except sqlite3.Error as exc:
+      logging.warning("DICOM header cache could not be opened: %s" % exc)
+
+  def closeDICOMHeaderCache(self):
+    headerIndex = getattr(self, "headerIndex", None)
+    if headerIndex and headerIndex.cache:
+      headerIndex.cache.close()
+      headerIndex.cache = None
+
   def resetIntraopDICOMReceiver(self):
     self.intraopDICOMReceiver = getattr(self, "intraopDICOMReceiver", None)
     if self.intraopDICOMReceiver:
@@ -410,36 +462,141 @@ class SliceTrackerSession(StepBasedSession):
     customStatusProgressBar.busy = "Waiting" in callData
 
   def importDICOMSeries(self, newFileList):
-    indexer = ctk.ctkDICOMIndexer()
+    newFileList = [os.path.join(self.intraopDICOMDirectory, f) for f in newFileList]
+    records = self.headerIndex.addFiles(newFileList, progressCallback=self.onDICOMHeadersRead)
+    if self.headerIndex.cache:
+      self.headerIndex.cache.commit()
 
-    newSeries = []
-    for currentIndex, currentFile in enumerate(newFileList, start=1):
+    indexer = ctk.ctkDICOMIndexer()
+    filesToIndex = [record.fileName for record in records
+                    if not record.fromCache or not self.isFileInDICOMDatabase(record.fileName)]
+    for currentIndex, currentFile in enumerate(filesToIndex, start=1):
       self.invokeEvent(SlicerDevelopmentToolboxEvents.NewFileIndexedEvent,
-                       ["Indexing file %s" % currentFile, len(newFileList), currentIndex].__str__())
+                       ["Indexing file %s" % currentFile, len(filesToIndex), currentIndex].__str__())
       slicer.app.processEvents()
-      currentFile = os.path.join(self.intraopDICOMDirectory, currentFile)
       indexer.addFile(slicer.dicomDatabase, currentFile, None)
-      series = self.makeSeriesNumberDescription(currentFile)
-      if series not in self.seriesList:
+
+    updatedSeries = set()
+    for record in records:
+      series = record.series
+      updatedSeries.add(series)
+      if series not in self.seriesList and series not in self.incompleteSeries:
         self.seriesTimeStamps[series] = self.getTime()
-        self.seriesList.append(series)
-        newSeries.append(series)
-        self.loadableList[series] = self.createLoadableFileListForSeries(series)
-    self.seriesList = sorted(self.seriesList, key=lambda s: RegistrationResult.getSeriesNumberFromString(s))
+        self.incompleteSeries.append(series)
+    for series in updatedSeries:
+      self.loadableList[series] = self.createLoadableFileListForSeries(series)
+    newSeries = self.collectCompletedSeries()
 
     if len(newFileList):
-      self.verifyPatientIDEquality(newFileList)
+      self.verifyPatientIDEquality(records)
+      newSeries = [series for series in newSeries if series in self.seriesList]
       self.invokeEvent(self.NewImageSeriesReceivedEvent, newSeries.__str__())
 
-  def verifyPatientIDEquality(self, receivedFiles):
-    seriesNumberPatientID = self.getAdditionalInformationForReceivedSeries(receivedFiles)
-    dicomFileName = self.getPatientIDValidationSource()
-    if not dicomFileName:
+  @staticmethod
+  def isFileInDICOMDatabase(fileName):
+    # the header cache outlives database switches and resets
+    return bool(slicer.dicomDatabase.instanceForFile(fileName))
+
+  def collectCompletedSeries(self):
+    timeout = float(self.getSetting("Series_Completion_Timeout") or 5)
+    completedSeries = [s for s in self.incompleteSeries if self.headerIndex.isSeriesComplete(s, timeout)]
+    for series in completedSeries:
+      self.incompleteSeries.remove(series)
+      self.seriesList.add(series)
+    if len(self.incompleteSeries):
+      self.seriesCompletionTimer.start(int(timeout * 1000))
+    self.schedulePrefetch(completedSeries)
+    return completedSeries
+
+  def resetSeriesCompletionTimer(self):
+    self.seriesCompletionTimer = getattr(self, "seriesCompletionTimer", None)
+    if not self.seriesCompletionTimer:
+      self.seriesCompletionTimer = qt.QTimer()
+      self.seriesCompletionTimer.setSingleShot(True)
+      self.seriesCompletionTimer.timeout.connect(self.onSeriesCompletionTimeout)
+    self.seriesCompletionTimer.stop()
+
+  def resetPrefetchTimer(self):
+    self.prefetchQueue = []
+    # a decode which is still running gets discarded
+    self.prefetchedSeries = None
+    self.prefetchResult = None
+    self.prefetchPool = getattr(self, "prefetchPool", None)
+    if not self.prefetchPool:
+      self.prefetchPool = ThreadPool(1)
+    self.prefetchTimer = getattr(self, "prefetchTimer", None)
+    if not self.prefetchTimer:
+      self.prefetchTimer = qt.QTimer()
+      self.prefetchTimer.setSingleShot(True)
+      self.prefetchTimer.timeout.connect(self.onPrefetchTimeout)
+    self.prefetchTimer.stop()
+
+  def schedulePrefetch(self, seriesList):
+    for series in seriesList:
+      if series not in self.prefetchQueue and \
+        self.seriesTypeManager.getSeriesType(series) in SliceTrackerConstants.TRACKABLE_IMAGE_TYPES:
+        self.prefetchQueue.append(series)
+    if len(self.prefetchQueue):
+      self.prefetchTimer.start(self.PREFETCH_INTERVAL)
+
+  def onPrefetchTimeout(self):
+    if self.prefetchResult:
+      if not self.prefetchResult.ready():
+        self.prefetchTimer.start(self.PREFETCH_POLLING_INTERVAL)
+        return
+      if self._busy:
+        self.prefetchTimer.start(self.PREFETCH_BUSY_RETRY_INTERVAL)
+        return
+      self.addPrefetchedVolume()
+    if not len(self.prefetchQueue):
       return
-    currentInfo = self.getPatientInformation(dicomFileName)
-    currentID = currentInfo["PatientID"]
-    patientName = currentInfo["PatientName"]
-    for seriesNumber, receivedInfo in seriesNumberPatientID.iteritems():
+    series = self.prefetchQueue.pop(0)
+    if series in self.seriesList and self.isTrackingPossible(series) and \
+      self.alreadyLoadedSeries.getFileCount(series) != len(self.loadableList[series]):
+      logging.debug("Prefetching volume for series %s" % series)
+      self.prefetchedSeries = (series, list(self.loadableList[series]))
+      self.prefetchResult = self.prefetchPool.apply_async(ParallelVolumeReader.readSeriesImageData,
+                                                          (self.prefetchedSeries[1],))
+      self.prefetchTimer.start(self.PREFETCH_POLLING_INTERVAL)
+    elif len(self.prefetchQueue):
+      self.prefetchTimer.start(self.PREFETCH_INTERVAL)
+
+  def addPrefetchedVolume(self):
+    series, files = self.prefetchedSeries
+    result, self.prefetchedSeries, self.prefetchResult = self.prefetchResult, None, None
+    try:
+      imageData, rasToIJK = result.get()
+    except Exception as exc:
+      logging.warning("Prefetching volume for series %s failed: %s" % (series, exc))
+      return
+    if self.loadableList.get(series) != files or self.alreadyLoadedSeries.getFileCount(series) == len(files):
+      return
+    self.invalidateLoadedVolumeForSeries(series)
+    volume = slicer.vtkMRMLScalarVolumeNode()
+    volume.SetName(series)
+    volume.SetRASToIJKMatrix(rasToIJK)
+    volume.SetAndObserveImageData(imageData)
+    slicer.mrmlScene.AddNode(volume)
+    volume.CreateDefaultDisplayNodes()
+    self.alreadyLoadedSeries.add(series, volume, len(files))
+
+  def onSeriesCompletionTimeout(self):
+    newSeries = self.collectCompletedSeries()
+    if len(newSeries):
+      self.invokeEvent(self.NewImageSeriesReceivedEvent, newSeries.__str__())
+
+  def onDICOMHeadersRead(self, numberOfReadFiles, numberOfFiles):
+    self.invokeEvent(SlicerDevelopmentToolboxEvents.NewFileIndexedEvent,
+                     ["Reading DICOM headers", numberOfFiles, numberOfReadFiles].__str__())
+    slicer.app.processEvents()
+
+  def verifyPatientIDEquality(self, receivedRecords):
+    referenceInfo = self.getReferencePatientInformation()
+    if not referenceInfo:
+      return
+    currentID = referenceInfo["PatientID"]
+    patientName = referenceInfo["PatientName"]
+    for seriesNumber, receivedInfo in self.getPatientInformationForReceivedSeries(receivedRecords).iteritems():
       patientID = receivedInfo["PatientID"]
       if patientID is not None and patientID != currentID:
         m = 'WARNING:\n' \
@@ -453,15 +610,17 @@ class SliceTrackerSession(StepBasedSession):
         if not slicer.util.confirmYesNoDisplay(m, title="Patient IDs Not Matching", windowTitle="SliceTracker"):
           self.deleteSeriesFromSeriesList(seriesNumber)
 
-  def getPatientIDValidationSource(self):
-    if len(self.loadableList.keys()) > 1:
-      keys = self.loadableList.keys()
-      keys.sort(key=lambda x: RegistrationResult.getSeriesNumberFromString(x))
-      return self.loadableList[keys[0]][0]
-    else:
-      return None
+  def getReferencePatientInformation(self):
+    if not self.referencePatientSeries and len(self.loadableList.keys()) > 1:
+      self.referencePatientSeries = min(self.loadableList.keys(),
+                                        key=lambda x: RegistrationResult.getSeriesNumberFromString(x))
+      self.referencePatientInformation = \
+        self.headerIndex.getFirstRecordForSeries(self.referencePatientSeries).getPatientInformation()
+    return self.referencePatientInformation
 
   def getOrCreateVolumeForSeries(self, series):
+    if self.alreadyLoadedSeries.getFileCount(series) != len(self.loadableList[series]):
+      self.invalidateLoadedVolumeForSeries(series)
     try:
       volume = self.alreadyLoadedSeries[series]
     except KeyError:
@@ -470,57 +629,52 @@ class SliceTrackerSession(StepBasedSession):
       assert len(loadables)
       volume = self.scalarVolumePlugin.load(loadables[0])
       volume.SetName(loadables[0].name)
-      self.alreadyLoadedSeries[series] = volume
+      self.alreadyLoadedSeries.add(series, volume, len(files))
     slicer.app.processEvents()
     return volume
 
+  def invalidateLoadedVolumeForSeries(self, series):
+    volume = self.alreadyLoadedSeries.pop(series)
+    if volume and not self.isLoadedVolumePinned(series, volume):
+      logging.debug("Removing partially loaded volume of series %s" % series)
+      slicer.mrmlScene.RemoveNode(volume)
+
+  def isLoadedVolumePinned(self, series, volume):
+    return series == self.currentSeries or self.isVolumeReferencedByResults(volume) or \
+           volume in [self.fixedVolume, self.movingVolume, self.data.initialVolume, self.approvedCoverTemplate]
+
+  def isVolumeReferencedByResults(self, volume):
+    return any(volume in result.volumes.getLoadedNodes().values() for result in self.data.getResultsAsList())
+
   def createLoadableFileListForSeries(self, series):
-    seriesNumber = RegistrationResult.getSeriesNumberFromString(series)
-    loadableList = []
-    for dcm in self.getFileList(self.intraopDICOMDirectory):
-      currentFile = os.path.join(self.intraopDICOMDirectory, dcm)
-      currentSeriesNumber = int(self.getDICOMValue(currentFile, DICOMTAGS.SERIES_NUMBER))
-      if currentSeriesNumber and currentSeriesNumber == seriesNumber:
-        loadableList.append(currentFile)
-    return loadableList
+    return self.headerIndex.getFilesForSeries(series)
 
   def deleteSeriesFromSeriesList(self, seriesNumber):
-    for series in self.seriesList:
-      currentSeriesNumber = RegistrationResult.getSeriesNumberFromString(series)
-      if currentSeriesNumber == seriesNumber:
+    incompleteSeries = [s for s in self.incompleteSeries
+                        if RegistrationResult.getSeriesNumberFromString(s) == seriesNumber]
+    for series in self.seriesList.getSeriesByNumber(seriesNumber) + incompleteSeries:
+      if series in self.seriesList:
         self.seriesList.remove(series)
-        for seriesFile in self.loadableList[series]:
-          logging.debug("removing {} from filesystem".format(seriesFile))
-          os.remove(seriesFile)
-        del self.loadableList[series]
-
-  def makeSeriesNumberDescription(self, dcmFile):
-    seriesDescription = self.getDICOMValue(dcmFile, DICOMTAGS.SERIES_DESCRIPTION)
-    seriesNumber = self.getDICOMValue(dcmFile, DICOMTAGS.SERIES_NUMBER)
-    if not (seriesNumber and seriesDescription):
-      raise DICOMValueError("Missing Attribute(s):\nFile: {}\nseriesNumber: {}\nseriesDescription: {}"
-                            .format(dcmFile, seriesNumber, seriesDescription))
-    return "{}: {}".format(seriesNumber, seriesDescription)
-
-  def getAdditionalInformationForReceivedSeries(self, fileList):
+      else:
+        self.incompleteSeries.remove(series)
+      for seriesFile in self.loadableList[series]:
+        logging.debug("removing {} from filesystem".format(seriesFile))
+        os.remove(seriesFile)
+      del self.loadableList[series]
+      self.headerIndex.removeSeries(series)
+      if series == self.referencePatientSeries:
+        self.referencePatientSeries = None
+        self.referencePatientInformation = None
+
+  def getPatientInformationForReceivedSeries(self, receivedRecords):
     seriesNumberPatientID = {}
-    for currentFile in [os.path.join(self.intraopDICOMDirectory, f) for f in fileList]:
-      seriesNumber = int(self.getDICOMValue(currentFile, DICOMTAGS.SERIES_NUMBER))
-      if seriesNumber not in seriesNumberPatientID.keys():
-        seriesNumberPatientID[seriesNumber]= self.getPatientInformation(currentFile)
+    for record in receivedRecords:
+      if record.seriesNumber not in seriesNumberPatientID.keys():
+        seriesNumberPatientID[record.seriesNumber] = record.getPatientInformation()
     return seriesNumberPatientID
 
-  def getPatientInformation(self, currentFile):
-    return {
-      "PatientID": self.getDICOMValue(currentFile, DICOMTAGS.PATIENT_ID),
-      "PatientName": self.getDICOMValue(currentFile, DICOMTAGS.PATIENT_NAME),
-      "SeriesDescription": self.getDICOMValue(currentFile, DICOMTAGS.SERIES_DESCRIPTION)}
-
   def getSeriesForSubstring(self, substring):
-    for series in reversed(self.seriesList):
-      if substring in series:
-        return series
-    return None
+    return self.seriesList.getMostRecentSeriesForTypeSubstring(substring)
 
   def loadCaseData(self):
     self._busy = True
@@ -754,14 +908,11 @@ class SliceTrackerSession(StepBasedSession):
 
   def skipAllUnregisteredPreviousSeries(self, series):
     selectedSeriesNumber = RegistrationResult.getSeriesNumberFromString(series)
-    for series in [series for series in self.seriesList if not self.seriesTypeManager.isCoverTemplate(series)]:
-      currentSeriesNumber = RegistrationResult.getSeriesNumberFromString(series)
-      if currentSeriesNumber < selectedSeriesNumber and self.isTrackingPossible(series):
-        results = self.data.getResultsBySeriesNumber(currentSeriesNumber)
-        if len(results) == 0:
-          self.skipSeries(series)
-      elif currentSeriesNumber >= selectedSeriesNumber:
-        break
+    for record in self.seriesList.getRecordsBefore(selectedSeriesNumber):
+      if self.seriesTypeManager.isCoverTemplate(record.name) or not self.isTrackingPossible(record.name):
+        continue
+      if len(self.data.getResultsBySeriesNumber(record.number)) == 0:
+        self.skipSeries(record.name)
 
   def skipSeries(self, series):
     volume = self.getOrCreateVolumeForSeries(series)
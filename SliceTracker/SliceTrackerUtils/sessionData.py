@@ -1,7 +1,10 @@
 import logging
 import slicer, vtk
 import os, json
-import shutil
+import hashlib
+import bisect
+import numpy
+from vtk.util import numpy_support
 from collections import OrderedDict
 
 from SlicerDevelopmentToolboxUtils.constants import FileExtension
@@ -11,14 +14,92 @@ from SlicerDevelopmentToolboxUtils.widgets import CustomStatusProgressbar
 
 from constants import SliceTrackerConstants
 from helpers import SeriesTypeManager
+from snapshotWriter import SnapshotWriter
+from resultsJournal import ResultsJournal
+from parallelVolumeReader import ParallelVolumeReader
+from logCapture import IncrementalLogCapture
 
 
-class SessionData(ModuleLogicMixin):
+class IncrementalSaveMixin(ModuleLogicMixin):
+  """ Skips writing nodes which were not modified since they were last written to (or read from) the same file """
+
+  _savedNodeModifiedTimes = {}
+
+  @staticmethod
+  def getNodeModifiedTime(node):
+    modifiedTimes = [node.GetMTime()]
+    for getter in ["GetImageData", "GetPolyData", "GetTransformToParent"]:
+      data = getattr(node, getter)() if hasattr(node, getter) else None
+      if data:
+        modifiedTimes.append(data.GetMTime())
+    if hasattr(node, "GetStorableModifiedTime"):
+      modifiedTimes.append(node.GetStorableModifiedTime())
+    return max(modifiedTimes)
+
+  def markNodeDataSaved(self, node, fileName):
+    IncrementalSaveMixin._savedNodeModifiedTimes[fileName] = (node.GetID(), self.getNodeModifiedTime(node))
+
+  @staticmethod
+  def onNodeDataWriteFailed(fileName):
+    IncrementalSaveMixin._savedNodeModifiedTimes.pop(fileName, None)
+
+  def isNodeDataModified(self, node, fileName):
+    return self._savedNodeModifiedTimes.get(fileName) != (node.GetID(), self.getNodeModifiedTime(node)) or \
+           not (os.path.exists(fileName) or SnapshotWriter().isPending(fileName))
+
+  def getCompressionProfile(self, node):
+    """ Returns the compression profile configured for the type of node or None for nodes without one """
+    if isinstance(node, slicer.vtkMRMLLabelMapVolumeNode):
+      setting = "Label_Compression"
+    elif isinstance(node, slicer.vtkMRMLScalarVolumeNode):
+      setting = "Volume_Compression"
+    elif isinstance(node, slicer.vtkMRMLTransformNode):
+      setting = "Transform_Compression"
+    else:
+      return None
+    compression = self.getSetting(setting, moduleName=SliceTrackerConstants.MODULE_NAME)
+    if compression in SnapshotWriter.COMPRESSION_PROFILES:
+      return compression
+    if compression:
+      logging.warning("Compression profile %s of %s is not supported, saving %s" %
+                      (compression, setting, SnapshotWriter.COMPRESSION_COMPRESSED))
+    return SnapshotWriter.COMPRESSION_COMPRESSED
+
+  def saveNodeDataIfModified(self, node, outputDir, extension, name=None):
+    name = self.replaceUnwantedCharacters(name if name else node.GetName())
+    fileName = os.path.join(outputDir, name + extension)
+    if not self.isNodeDataModified(node, fileName):
+      logging.debug("Skipping save of unmodified node %s" % node.GetName())
+      return True, name
+    compression = self.getCompressionProfile(node)
+    if extension == FileExtension.NRRD and isinstance(node, slicer.vtkMRMLScalarVolumeNode) and node.GetImageData():
+      self.markNodeDataSaved(node, fileName)
+      SnapshotWriter().writeVolume(node, fileName, onFailure=self.onNodeDataWriteFailed, compression=compression)
+      return True, name
+    if extension == FileExtension.H5 and isinstance(node, slicer.vtkMRMLTransformNode) and \
+       node.GetTransformToParent():
+      self.markNodeDataSaved(node, fileName)
+      SnapshotWriter().writeTransform(node, fileName, onFailure=self.onNodeDataWriteFailed, compression=compression)
+      return True, name
+    if compression:
+      success = slicer.util.saveNode(node, fileName,
+                                     properties={"useCompression": int(compression != SnapshotWriter.COMPRESSION_RAW)})
+    else:
+      success, name = self.saveNodeData(node, outputDir, extension, name=name)
+    if success:
+      self.markNodeDataSaved(node, fileName)
+    else:
+      IncrementalSaveMixin._savedNodeModifiedTimes.pop(fileName, None)
+    return success, name
+
+
+class SessionData(IncrementalSaveMixin):
 
   NewResultCreatedEvent = vtk.vtkCommand.UserEvent + 901
 
   _completed = False
   _resumed = False
+  _revisionInformation = None
 
   @property
   def completed(self):
@@ -43,10 +124,8 @@ class SessionData(ModuleLogicMixin):
 
   @staticmethod
   def wasSessionCompleted(filename):
-    with open(filename) as data_file:
-      data = json.load(data_file)
-      procedureEvents = data["procedureEvents"]
-      return "caseCompleted" in procedureEvents.keys()
+    procedureEvents = ResultsJournal.read(filename)["procedureEvents"]
+    return "caseCompleted" in procedureEvents.keys()
 
   @property
   def usedAutomaticPreopSegmentation(self):
@@ -64,6 +143,8 @@ class SessionData(ModuleLogicMixin):
 
   def __init__(self):
     self.resetAndInitializeData()
+    # resolved here so that saving never reads version.json or walks the git repository
+    self.resolveGITRevisionInformation()
 
   def resetAndInitializeData(self):
     self.seriesTypeManager = SeriesTypeManager()
@@ -84,14 +165,66 @@ class SessionData(ModuleLogicMixin):
 
     self.zFrameRegistrationResult = None
 
-    self._savedRegistrationResults = []
     self.initializeRegistrationResults()
 
     self.customProgressBar = CustomStatusProgressbar()
     self.alreadyLoadedFileNames = {}
+    self.resultsJournal = None
 
   def initializeRegistrationResults(self):
+    for result in getattr(self, "registrationResults", {}).values():
+      self._removeResultStatusObservers(result)
     self.registrationResults = OrderedDict()
+    self._resultsBySeriesNumber = {}
+    self._approvedResults = []
+    self._approvedSeriesNumbers = []
+    self._indexedStatuses = {}
+    self._statusCounts = {}
+
+  def _addResultToIndexes(self, result):
+    self._resultsBySeriesNumber.setdefault(result.seriesNumber, []).append(result)
+    self._indexedStatuses[result.name] = result.status
+    self._statusCounts[result.status] = self._statusCounts.get(result.status, 0) + 1
+    if result.approved:
+      self._addApprovedResult(result)
+    for event in RegistrationStatus.StatusEvents.values():
+      result.addEventObserver(event, self.onResultStatusChanged)
+
+  def _removeResultFromIndexes(self, result):
+    self._removeResultStatusObservers(result)
+    self._resultsBySeriesNumber[result.seriesNumber].remove(result)
+    if not self._resultsBySeriesNumber[result.seriesNumber]:
+      del self._resultsBySeriesNumber[result.seriesNumber]
+    status = self._indexedStatuses.pop(result.name)
+    self._statusCounts[status] -= 1
+    if status == RegistrationStatus.APPROVED_STATUS:
+      self._removeApprovedResult(result)
+
+  def _removeResultStatusObservers(self, result):
+    for event in RegistrationStatus.StatusEvents.values():
+      result.removeEventObserver(event, self.onResultStatusChanged)
+
+  def _addApprovedResult(self, result):
+    index = bisect.bisect_right(self._approvedSeriesNumbers, result.seriesNumber)
+    self._approvedSeriesNumbers.insert(index, result.seriesNumber)
+    self._approvedResults.insert(index, result)
+
+  def _removeApprovedResult(self, result):
+    index = self._approvedResults.index(result)
+    del self._approvedSeriesNumbers[index]
+    del self._approvedResults[index]
+
+  def onResultStatusChanged(self, caller, event):
+    previousStatus = self._indexedStatuses[caller.name]
+    if previousStatus == caller.status:
+      return
+    self._indexedStatuses[caller.name] = caller.status
+    self._statusCounts[previousStatus] -= 1
+    self._statusCounts[caller.status] = self._statusCounts.get(caller.status, 0) + 1
+    if previousStatus == RegistrationStatus.APPROVED_STATUS:
+      self._removeApprovedResult(caller)
+    if caller.approved:
+      self._addApprovedResult(caller)
 
   def createZFrameRegistrationResult(self, series):
     self.zFrameRegistrationResult = ZFrameRegistrationResult(series)
@@ -100,6 +233,7 @@ class SessionData(ModuleLogicMixin):
   def createResult(self, series, invokeEvent=True):
     assert series not in self.registrationResults.keys()
     self.registrationResults[series] = RegistrationResult(series)
+    self._addResultToIndexes(self.registrationResults[series])
     if invokeEvent is True:
       self.invokeEvent(self.NewResultCreatedEvent, series)
     return self.registrationResults[series]
@@ -107,20 +241,59 @@ class SessionData(ModuleLogicMixin):
   def load(self, filename):
     directory = os.path.dirname(filename)
     self.resetAndInitializeData()
-    with open(filename) as dataFile:
-      self.customProgressBar.visible = True
-      self.customProgressBar.text = "Reading meta information"
-
-      logging.debug("reading json file %s" % filename)
-      data = json.load(dataFile)
-      self.readInitialTargetsAndVolume(data, directory)
-      self.loadZFrameRegistrationData(data, directory)
-      self.loadProcedureEvents(data)
-      self.loadPreopData(data)
-      self.loadResults(data, directory)
+    self.customProgressBar.visible = True
+    self.customProgressBar.text = "Reading meta information"
+
+    logging.debug("reading json file %s" % filename)
+    self.resultsJournal = ResultsJournal(filename, SnapshotWriter())
+    data = self.resultsJournal.load()
+    self.preloadVolumes(data, directory)
+    self.readInitialTargetsAndVolume(data, directory)
+    self.loadZFrameRegistrationData(data, directory)
+    self.loadProcedureEvents(data)
+    self.loadPreopData(data)
+    self.loadResults(data, directory)
     self.registrationResults = OrderedDict(sorted(self.registrationResults.items()))
+    for results in self._resultsBySeriesNumber.values():
+      results.sort(key=lambda r: r.name)
     return True
 
+  def getVolumeFileNamesToPreload(self, data):
+    """ Returns the volume and label files which are accessed right after resuming a case """
+    volumes = []
+    labels = []
+    if data.get("initialVolume"):
+      volumes.append(data["initialVolume"])
+    if data.get("zFrameRegistration", {}).get("volume"):
+      volumes.append(data["zFrameRegistration"]["volume"])
+    approved = [r for r in data["results"] if r.get("status", {}).get("state") == RegistrationStatus.APPROVED_STATUS]
+    coverProstate = [r for r in approved if r.get("series", {}).get("type") == SliceTrackerConstants.COVER_PROSTATE]
+    for result in coverProstate[:1] + approved[-1:]:
+      volumes += [f for f in result.get("volumes", {}).values() if f]
+      labels += [f for f in result.get("labels", {}).values() if f]
+    return volumes, labels
+
+  def preloadVolumes(self, data, directory):
+    volumes, labels = self.getVolumeFileNamesToPreload(data)
+    volumes = [f for f in volumes if f not in self.alreadyLoadedFileNames]
+    labels = [f for f in labels if f not in self.alreadyLoadedFileNames]
+    if not volumes and not labels:
+      return
+
+    def onProgress(finished, total):
+      self.customProgressBar.maximum = total
+      self.customProgressBar.updateStatus("Reading volumes (%d/%d)" % (finished, total), finished)
+      slicer.app.processEvents()
+
+    loaded = ParallelVolumeReader().read([os.path.join(directory, f) for f in volumes],
+                                         [os.path.join(directory, f) for f in labels], progressCallback=onProgress)
+    for filename in volumes + labels:
+      volume = loaded.get(os.path.join(directory, filename))
+      if volume:
+        self.alreadyLoadedFileNames[filename] = volume
+        self.markNodeDataSaved(volume, os.path.join(directory, filename))
+        ContentAddressedData.registerLoadedBlob(volume, filename)
+
   def readInitialTargetsAndVolume(self, data, directory):
     if "initialTargets" in data.keys():
       self.initialTargets = self._loadOrGetFileData(directory, data["initialTargets"],
@@ -171,22 +344,21 @@ class SessionData(ModuleLogicMixin):
       for attribute, value in jsonResult.iteritems():
         logging.debug("found %s: %s" % (attribute, value))
         if attribute == 'volumes':
-          self._loadResultFileData(value, directory, slicer.util.loadVolume, result.setVolume)
+          self._setLazyResultFileData(result.volumes, value, directory, slicer.util.loadVolume)
         elif attribute == 'transforms':
-          self._loadResultFileData(value, directory, slicer.util.loadTransform, result.setTransform)
+          self._setLazyResultFileData(result.transforms, value, directory, slicer.util.loadTransform)
         elif attribute == 'targets':
           approved = value.pop('approved', None)
           original = value.pop('original', None)
-          self._loadResultFileData(value, directory, slicer.util.loadMarkupsFiducialList, result.setTargets)
+          self._setLazyResultFileData(result.targets, value, directory, slicer.util.loadMarkupsFiducialList)
           if approved:
-            approvedTargets = self._loadOrGetFileData(directory, approved["fileName"], slicer.util.loadMarkupsFiducialList)
-            setattr(result.targets, 'approved', approvedTargets)
+            self._setLazyFileData(result.targets, 'approved', directory, approved["fileName"],
+                                  slicer.util.loadMarkupsFiducialList)
             result.targets.modifiedTargets[jsonResult["status"]["registrationType"]] = approved["userModified"]
           if original:
-            originalTargets = self._loadOrGetFileData(directory, original, slicer.util.loadMarkupsFiducialList)
-            setattr(result.targets, 'original', originalTargets)
+            self._setLazyFileData(result.targets, 'original', directory, original, slicer.util.loadMarkupsFiducialList)
         elif attribute == 'labels':
-          self._loadResultFileData(value, directory, slicer.util.loadLabelVolume, result.setLabel)
+          self._setLazyResultFileData(result.labels, value, directory, slicer.util.loadLabelVolume)
         elif attribute == 'status':
           result.status = value["state"]
           result.timestamp = value["time"]
@@ -205,10 +377,15 @@ class SessionData(ModuleLogicMixin):
           setattr(result, attribute, value)
         self.customProgressBar.text = "Finished loading registration results"
 
-  def _loadResultFileData(self, dictionary, directory, loadFunction, setFunction):
+  def _setLazyResultFileData(self, data, dictionary, directory, loadFunction):
     for regType, filename in dictionary.iteritems():
-      data = self._loadOrGetFileData(directory, filename, loadFunction)
-      setFunction(regType, data)
+      self._setLazyFileData(data, regType, directory, filename, loadFunction)
+
+  def _setLazyFileData(self, data, name, directory, filename, loadFunction):
+    if not filename:
+      setattr(data, name, None)
+      return
+    data.setLazy(name, filename, lambda: self._loadOrGetFileData(directory, filename, loadFunction))
 
   def _loadOrGetFileData(self, directory, filename, loadFunction):
     if not filename:
@@ -218,6 +395,10 @@ class SessionData(ModuleLogicMixin):
     except KeyError:
       _, data = loadFunction(os.path.join(directory, filename), returnNode=True)
       self.alreadyLoadedFileNames[filename] = data
+      if data:
+        self.markNodeDataSaved(data, os.path.join(directory, filename))
+        if isinstance(data, slicer.vtkMRMLVolumeNode):
+          ContentAddressedData.registerLoadedBlob(data, filename)
     return data
 
   def generateLogfileTimeStampDict(self):
@@ -229,9 +410,10 @@ class SessionData(ModuleLogicMixin):
   def close(self, outputDir):
     if not self.completed:
       self.closedLogTimeStamps.append(self.generateLogfileTimeStampDict())
-    return self.save(outputDir)
+    return self.save(outputDir, compact=True)
 
-  def save(self, outputDir):
+  def save(self, outputDir, asynchronous=False, compact=False):
+    """ Unless asynchronous is True, waits until the SnapshotWriter wrote volumes and the results journal """
     if not os.path.exists(outputDir):
       self.createDirectory(outputDir)
 
@@ -239,26 +421,26 @@ class SessionData(ModuleLogicMixin):
     failedSaveOfFileNames = []
 
     logFilePath = self.getSlicerErrorLogPath()
-    shutil.copy(logFilePath, os.path.join(outputDir, os.path.basename(logFilePath)))
+    IncrementalLogCapture.capture(logFilePath, os.path.join(outputDir, os.path.basename(logFilePath)))
     successfullySavedFileNames.append(os.path.join(outputDir, os.path.basename(logFilePath)))
 
     def saveManualSegmentation():
       if self.segmentModelNode:
-        success, name = self.saveNodeData(self.segmentModelNode, outputDir, FileExtension.VTK)
+        success, name = self.saveNodeDataIfModified(self.segmentModelNode, outputDir, FileExtension.VTK)
         self.handleSaveNodeDataReturn(success, name, successfullySavedFileNames, failedSaveOfFileNames)
 
       if self.inputMarkupNode:
-        success, name = self.saveNodeData(self.inputMarkupNode, outputDir, FileExtension.FCSV)
+        success, name = self.saveNodeDataIfModified(self.inputMarkupNode, outputDir, FileExtension.FCSV)
         self.handleSaveNodeDataReturn(success, name, successfullySavedFileNames, failedSaveOfFileNames)
 
     def saveInitialTargets():
-      success, name = self.saveNodeData(self.initialTargets, outputDir, FileExtension.FCSV,
-                                        name="Initial_Targets")
+      success, name = self.saveNodeDataIfModified(self.initialTargets, outputDir, FileExtension.FCSV,
+                                                  name="Initial_Targets")
       self.handleSaveNodeDataReturn(success, name, successfullySavedFileNames, failedSaveOfFileNames)
       return name + FileExtension.FCSV
 
     def saveInitialVolume():
-      success, name = self.saveNodeData(self.initialVolume, outputDir, FileExtension.NRRD)
+      success, name = self.saveNodeDataIfModified(self.initialVolume, outputDir, FileExtension.NRRD)
       self.handleSaveNodeDataReturn(success, name, successfullySavedFileNames, failedSaveOfFileNames)
       return name + FileExtension.NRRD
 
@@ -303,20 +485,37 @@ class SessionData(ModuleLogicMixin):
     if self.initialVolume:
       data["initialVolume"] = saveInitialVolume()
 
-    destinationFile = os.path.join(outputDir, SliceTrackerConstants.JSON_FILENAME)
-    with open(destinationFile, 'w') as outfile:
-      logging.debug("Writing registration results to %s" % destinationFile)
-      json.dump(data, outfile, indent=2)
-
     failedSaveOfFileNames += self.saveRegistrationResults(outputDir)
 
+    destinationFile = os.path.join(outputDir, SliceTrackerConstants.JSON_FILENAME)
+    if not self.resultsJournal or self.resultsJournal.resultsFile != destinationFile:
+      self.resultsJournal = ResultsJournal(destinationFile, SnapshotWriter())
+    logging.debug("Writing registration results to %s" % destinationFile)
+    self.resultsJournal.write(data, compact=compact)
+    if not asynchronous:
+      failedSaveOfFileNames += SnapshotWriter().flush()
+
     self.printOutput("The following data was successfully saved:\n", successfullySavedFileNames)
     self.printOutput("The following data failed to saved:\n", failedSaveOfFileNames)
     return len(failedSaveOfFileNames) == 0, failedSaveOfFileNames
 
-  def getGITRevisionInformation(self):
+  @classmethod
+  def resolveGITRevisionInformation(cls, refresh=False):
+    """ Failures are logged and retried the next time SessionData gets created """
+    if refresh or cls._revisionInformation is None:
+      try:
+        cls._revisionInformation = cls._readGITRevisionInformation()
+      except Exception as exc:
+        logging.warning("Could not resolve the revision information of SliceTracker: %s" % exc)
+
+  @classmethod
+  def getGITRevisionInformation(cls):
+    return dict(cls._revisionInformation or {})
+
+  @classmethod
+  def _readGITRevisionInformation(cls):
     import inspect
-    dirname = os.path.dirname(inspect.getfile(self.__class__))
+    dirname = os.path.dirname(inspect.getfile(cls))
 
     def getLocalGITRevisionInformation():
       try:
@@ -355,17 +554,16 @@ class SessionData(ModuleLogicMixin):
       self.customProgressBar.maximum = len(self.registrationResults)
       self.customProgressBar.updateStatus("Saving registration result for series %s" % result.name, index)
       slicer.app.processEvents()
-      if result not in self._savedRegistrationResults:
-        successfulList, failedList = result.save(outputDir)
-        failedToSave += failedList
-        self._savedRegistrationResults.append(result)
-    self.customProgressBar.text = "Registration data successfully saved" if len(failedToSave) == 0 else "Error/s occurred during saving"
+      successfulList, failedList = result.save(outputDir)
+      failedToSave += failedList
+    self.customProgressBar.text = "Registration data successfully saved" if len(failedToSave) == 0 else \
+      "Error/s occurred during saving"
     return failedToSave
 
   def _registrationResultHasStatus(self, series, status, method=all):
     if not type(series) is int:
       series = RegistrationResult.getSeriesNumberFromString(series)
-    results = self.getResultsBySeriesNumber(series)
+    results = self._resultsBySeriesNumber.get(series, [])
     return method(result.status == status for result in results) if len(results) else False
 
   def registrationResultWasApproved(self, series):
@@ -384,15 +582,22 @@ class SessionData(ModuleLogicMixin):
   def getResultsAsList(self):
     return self.registrationResults.values()
 
+  def getApprovedResults(self):
+    """ Returns the approved results ordered by series number """
+    return list(self._approvedResults)
+
+  def getNumberOfResultsWithStatus(self, status):
+    return self._statusCounts.get(status, 0)
+
   def getMostRecentApprovedCoverProstateRegistration(self):
     seriesTypeManager = SeriesTypeManager()
-    for result in self.registrationResults.values():
-      if seriesTypeManager.isCoverProstate(result.name) and result.approved:
+    for result in self._approvedResults:
+      if seriesTypeManager.isCoverProstate(result.name):
         return result
     return None
 
   def getLastApprovedRigidTransformation(self):
-    if sum([1 for result in self.registrationResults.values() if result.approved]) == 1:
+    if self.getNumberOfResultsWithStatus(RegistrationStatus.APPROVED_STATUS) == 1:
       lastRigidTfm = None
     else:
       lastRigidTfm = self.getMostRecentApprovedResult().transforms.rigid
@@ -404,9 +609,8 @@ class SessionData(ModuleLogicMixin):
   @onExceptionReturnNone
   def getMostRecentApprovedTransform(self):
     seriesTypeManager = SeriesTypeManager()
-    results = sorted(self.registrationResults.values(), key=lambda s: s.seriesNumber)
-    for result in reversed(results):
-      if result.approved and not seriesTypeManager.isCoverProstate(result.name):
+    for result in reversed(self._approvedResults):
+      if not seriesTypeManager.isCoverProstate(result.name):
         return result.getTransform(result.registrationType)
     return None
 
@@ -419,12 +623,12 @@ class SessionData(ModuleLogicMixin):
     return self.getResultsBySeriesNumber(seriesNumber)
 
   def getResultsBySeriesNumber(self, seriesNumber):
-    return [result for result in self.getResultsAsList() if seriesNumber == result.seriesNumber]
+    return list(self._resultsBySeriesNumber.get(seriesNumber, []))
 
   def removeResult(self, series):
     # TODO: is this method ever used?
     try:
-      del self.registrationResults[series]
+      self._removeResultFromIndexes(self.registrationResults.pop(series))
     except KeyError:
       pass
 
@@ -433,13 +637,10 @@ class SessionData(ModuleLogicMixin):
 
   @onExceptionReturnNone
   def getMostRecentApprovedResult(self, priorToSeriesNumber=None):
-    results = sorted(self.registrationResults.values(), key=lambda s: s.seriesNumber)
+    index = len(self._approvedResults)
     if priorToSeriesNumber:
-      results = [result for result in results if result.seriesNumber < priorToSeriesNumber]
-    for result in reversed(results):
-      if result.approved:
-        return result
-    return None
+      index = bisect.bisect_left(self._approvedSeriesNumbers, priorToSeriesNumber)
+    return self._approvedResults[index - 1] if index else None
 
   def getApprovedOrLastResultForSeries(self, series):
     results = self.getResultsBySeries(series)
@@ -449,13 +650,41 @@ class SessionData(ModuleLogicMixin):
     return results[-1]
 
 
-class AbstractRegistrationData(ModuleLogicMixin):
+class AbstractRegistrationData(IncrementalSaveMixin):
+  """ Attributes set by setLazy are loaded the first time they are accessed """
 
   FILE_EXTENSION = None
 
   def __init__(self):
+    self._lazyAttributes = {}
     self.initializeMembers()
 
+  def __getattr__(self, name):
+    # only called for attributes which are not set, i.e. lazy attributes which were not accessed yet
+    lazyAttributes = self.__dict__.get("_lazyAttributes", {})
+    if name not in lazyAttributes:
+      raise AttributeError(name)
+    fileName, load = lazyAttributes.pop(name)
+    logging.debug("Loading %s on first access" % fileName)
+    node = load()
+    setattr(self, name, node)
+    return node
+
+  def __setattr__(self, name, value):
+    self.__dict__.get("_lazyAttributes", {}).pop(name, None)
+    super(AbstractRegistrationData, self).__setattr__(name, value)
+
+  def setLazy(self, name, fileName, load):
+    """ Defers calling load() for attribute name until it is accessed. fileName is reported until then """
+    self.__dict__.pop(name, None)
+    self._lazyAttributes[name] = (fileName, load)
+
+  def isLoaded(self, name):
+    return name not in self._lazyAttributes
+
+  def getLoadedNodes(self):
+    return dict((name, value) for name, value in vars(self).iteritems() if isinstance(value, slicer.vtkMRMLNode))
+
   def initializeMembers(self):
     raise NotImplementedError
 
@@ -472,21 +701,93 @@ class AbstractRegistrationData(ModuleLogicMixin):
     return self.replaceUnwantedCharacters(node.GetName()) + self.FILE_EXTENSION
 
   def getFileNameByAttributeName(self, name):
+    if not self.isLoaded(name):
+      return self._lazyAttributes[name][0]
     return self.getFileName(getattr(self, name))
 
   def getAllFileNames(self):
-    fileNames = {}
-    for regType, node in self.asDict().iteritems():
-      if node:
-        fileNames[regType] = self.getFileName(node)
+    fileNames = dict((name, fileName) for name, (fileName, _) in self._lazyAttributes.iteritems())
+    for regType, node in self.getLoadedNodes().iteritems():
+      fileNames[regType] = self.getFileName(node)
     return fileNames
 
   def save(self, directory):
     assert self.FILE_EXTENSION is not None
     savedSuccessfully = []
     failedToSave = []
-    for node in [node for node in self.asList() if node]:
-      success, name = self.saveNodeData(node, directory, self.FILE_EXTENSION)
+    for node in self.getLoadedNodes().values():
+      success, name = self.saveNodeDataIfModified(node, directory, self.FILE_EXTENSION)
+      self.handleSaveNodeDataReturn(success, name, savedSuccessfully, failedToSave)
+    return savedSuccessfully, failedToSave
+
+
+class ContentAddressedData(AbstractRegistrationData):
+  """ Volumes with identical content share one file below blobs/<hash>/, named after the first of them """
+
+  FILE_EXTENSION = FileExtension.NRRD
+  BLOB_DIRECTORY = "blobs"
+
+  _contentHashes = {}
+  _blobFileNames = {}
+
+  @classmethod
+  def getContentHash(cls, volume):
+    modifiedTime = cls.getNodeModifiedTime(volume)
+    cached = cls._contentHashes.get(volume.GetID())
+    if cached and cached[0] == modifiedTime:
+      return cached[1]
+    imageData = volume.GetImageData()
+    rasToIJK = vtk.vtkMatrix4x4()
+    volume.GetRASToIJKMatrix(rasToIJK)
+    contentHash = hashlib.sha1()
+    contentHash.update(repr([volume.GetClassName(), imageData.GetScalarTypeAsString(),
+                             imageData.GetNumberOfScalarComponents(), imageData.GetDimensions(),
+                             [rasToIJK.GetElement(row, column) for row in range(4) for column in range(4)]]))
+    voxels = numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars())
+    contentHash.update(numpy.ascontiguousarray(voxels).data)
+    cls._contentHashes[volume.GetID()] = (modifiedTime, contentHash.hexdigest())
+    return contentHash.hexdigest()
+
+  @classmethod
+  def registerLoadedBlob(cls, volume, fileName):
+    """ Takes the hash of a volume read from a blob file from its path instead of hashing the voxels again """
+    parts = fileName.split("/")
+    if len(parts) != 3 or parts[0] != cls.BLOB_DIRECTORY:
+      return
+    cls._contentHashes[volume.GetID()] = (cls.getNodeModifiedTime(volume), parts[1])
+    cls._blobFileNames.setdefault(parts[1], fileName)
+
+  def getFileName(self, node):
+    if node is None or node.GetImageData() is None:
+      return None
+    try:
+      contentHash = self.getContentHash(node)
+    except Exception as exc:
+      logging.error("Hashing %s failed, storing it without deduplication: %s" % (node.GetName(), exc))
+      return super(ContentAddressedData, self).getFileName(node)
+    if contentHash not in self._blobFileNames:
+      self._blobFileNames[contentHash] = "/".join([self.BLOB_DIRECTORY, contentHash,
+                                                  self.replaceUnwantedCharacters(node.GetName()) + self.FILE_EXTENSION])
+    return self._blobFileNames[contentHash]
+
+  def save(self, directory):
+    savedSuccessfully = []
+    failedToSave = []
+    for node in self.getLoadedNodes().values():
+      fileName = self.getFileName(node)
+      if not fileName or not fileName.startswith(self.BLOB_DIRECTORY + "/"):
+        success, name = self.saveNodeDataIfModified(node, directory, self.FILE_EXTENSION)
+      else:
+        blobDirectory, name = os.path.split(os.path.join(directory, fileName))
+        name = os.path.splitext(name)[0]
+        blobFileName = os.path.join(blobDirectory, name + self.FILE_EXTENSION)
+        if os.path.exists(blobFileName) or SnapshotWriter().isPending(blobFileName):
+          logging.debug("Content of %s is already stored in %s" % (node.GetName(), fileName))
+          success = True
+        else:
+          if not os.path.exists(blobDirectory):
+            self.createDirectory(blobDirectory)
+          success, name = self.saveNodeDataIfModified(node, blobDirectory, self.FILE_EXTENSION, name=name)
       self.handleSaveNodeDataReturn(success, name, savedSuccessfully, failedToSave)
     return savedSuccessfully, failedToSave
 
@@ -509,7 +810,7 @@ class Serializable(object):
     raise NotImplementedError
 
 
-class SegmentationData(Serializable, ModuleLogicMixin):
+class SegmentationData(Serializable, IncrementalSaveMixin):
 
   FILE_EXTENSION = FileExtension.NRRD
 
@@ -566,11 +867,11 @@ class SegmentationData(Serializable, ModuleLogicMixin):
     savedSuccessfully = []
     failedToSave = []
     if self._label:
-      success, name = self.saveNodeData(self._label, directory, self.FILE_EXTENSION)
+      success, name = self.saveNodeDataIfModified(self._label, directory, self.FILE_EXTENSION)
       self.fileName = name + self.FILE_EXTENSION if success else None
       self.handleSaveNodeDataReturn(success, name, savedSuccessfully, failedToSave)
     if self._modifiedLabel:
-      success, name = self.saveNodeData(self._modifiedLabel, directory, self.FILE_EXTENSION)
+      success, name = self.saveNodeDataIfModified(self._modifiedLabel, directory, self.FILE_EXTENSION)
       self.userModified["fileName"] = name + self.FILE_EXTENSION if success else None
       self.handleSaveNodeDataReturn(success, name, savedSuccessfully, failedToSave)
     return savedSuccessfully, failedToSave
@@ -650,13 +951,6 @@ class Targets(RegistrationTypeData):
                                         cloneName=approvedTargets.GetName().replace(registrationType, "approved"),
                                         keepDisplayNode=True)
 
-  def save(self, directory):
-    savedSuccessfully, failedToSave = super(Targets, self).save(directory)
-    if self.approved:
-      success, name = self.saveNodeData(self.approved, directory, self.FILE_EXTENSION)
-      self.handleSaveNodeDataReturn(success, name, savedSuccessfully, failedToSave)
-    return savedSuccessfully, failedToSave
-
   def isGoingToBeMoved(self, targetList, index):
     assert targetList in self.asList()
     regType = self.getRegistrationTypeForTargetList(targetList)
@@ -671,9 +965,7 @@ class Targets(RegistrationTypeData):
     return None
 
 
-class Volumes(RegistrationTypeData):
-
-  FILE_EXTENSION = FileExtension.NRRD
+class Volumes(RegistrationTypeData, ContentAddressedData):
 
   def __init__(self):
     super(Volumes, self).__init__()
@@ -692,9 +984,7 @@ class Volumes(RegistrationTypeData):
     return dictionary
 
 
-class Labels(AbstractRegistrationData):
-
-  FILE_EXTENSION = FileExtension.NRRD
+class Labels(ContentAddressedData):
 
   def __init__(self):
     super(Labels, self).__init__()
@@ -780,7 +1070,7 @@ class RegistrationStatus(ModuleLogicMixin):
     return data
 
 
-class RegistrationResultBase(ModuleLogicMixin):
+class RegistrationResultBase(IncrementalSaveMixin):
 
   @property
   def name(self):
@@ -893,8 +1183,8 @@ class RegistrationResult(RegistrationResultBase, RegistrationStatus):
   @logmethod(logging.DEBUG)
   def save(self, outputDir):
     def saveCMDParameters():
-      if self.cmdArguments != "":
-        filename = os.path.join(outputDir, self.cmdFileName)
+      filename = os.path.join(outputDir, self.cmdFileName)
+      if self.cmdArguments != "" and not os.path.exists(filename):
         f = open(filename, 'w+')
         f.write(self.cmdArguments)
         f.close()
@@ -947,7 +1237,7 @@ class RegistrationResult(RegistrationResultBase, RegistrationStatus):
         dictionary["status"]["registrationType"] = self.registrationType
     elif self.skipped:
       dictionary["volumes"] = {
-        "fixed": self.volumes.getFileName(self.volumes.fixed)
+        "fixed": self.volumes.getFileNameByAttributeName("fixed")
       }
     if self.score:
       dictionary["score"] = self.score
@@ -976,10 +1266,10 @@ class ZFrameRegistrationResult(RegistrationResultBase):
     }
     savedSuccessfully = []
     failedToSave = []
-    success, name = self.saveNodeData(self.transform, outputDir, FileExtension.H5)
+    success, name = self.saveNodeDataIfModified(self.transform, outputDir, FileExtension.H5)
     dictionary["transform"] = name + FileExtension.H5
     self.handleSaveNodeDataReturn(success, name, savedSuccessfully, failedToSave)
-    success, name = self.saveNodeData(self.volume, outputDir, FileExtension.NRRD)
+    success, name = self.saveNodeDataIfModified(self.volume, outputDir, FileExtension.NRRD)
     dictionary["volume"] = name + FileExtension.NRRD
     self.handleSaveNodeDataReturn(success, name, savedSuccessfully, failedToSave)
     return dictionary
\ No newline at end of file
@@ -0,0 +1,142 @@
+import os, logging
+import threading
+import Queue
+import vtk, qt
+import slicer
+
+from SlicerDevelopmentToolboxUtils.mixins import ModuleLogicMixin
+from SlicerDevelopmentToolboxUtils.metaclasses import Singleton
+
+from helpers import replaceFile
+
+
+class SnapshotWriter(ModuleLogicMixin):
+  """ Writes snapshots of session data in queue order on a single background thread """
+
+  __metaclass__ = Singleton
+
+  SnapshotWrittenEvent = vtk.vtkCommand.UserEvent + 171
+  SnapshotWriteFailedEvent = vtk.vtkCommand.UserEvent + 172
+
+  RESULT_POLLING_INTERVAL = 100
+
+  COMPRESSION_RAW = "raw"
+  COMPRESSION_COMPRESSED = "compressed"
+  COMPRESSION_PROFILES = [COMPRESSION_RAW, COMPRESSION_COMPRESSED]
+
+  def __init__(self):
+    self._tasks = Queue.Queue()
+    self._results = Queue.Queue()
+    self._pendingFileNames = {}
+    self._failedFileNames = []
+    self._worker = threading.Thread(target=self._processTasks)
+    self._worker.daemon = True
+    self._worker.start()
+    self.resultTimer = qt.QTimer()
+    self.resultTimer.setInterval(self.RESULT_POLLING_INTERVAL)
+    self.resultTimer.timeout.connect(self.dispatchResults)
+
+  def isPending(self, fileName):
+    return fileName in self._pendingFileNames
+
+  def hasPendingWrites(self):
+    return len(self._pendingFileNames) > 0
+
+  def writeVolume(self, volume, fileName, onFailure=None, compression=COMPRESSION_COMPRESSED):
+    """ Label maps whose values fit are written as unsigned char """
+    imageData = vtk.vtkImageData()
+    imageData.DeepCopy(volume.GetImageData())
+    rasToIJK = vtk.vtkMatrix4x4()
+    volume.GetRASToIJKMatrix(rasToIJK)
+    castToUnsignedChar = isinstance(volume, slicer.vtkMRMLLabelMapVolumeNode) and \
+                         imageData.GetScalarType() != vtk.VTK_UNSIGNED_CHAR and \
+                         imageData.GetNumberOfScalarComponents() == 1 and \
+                         0 <= imageData.GetScalarRange()[0] and imageData.GetScalarRange()[1] <= 255
+    self.enqueue(fileName, self._writeImageData, (imageData, rasToIJK, fileName, compression, castToUnsignedChar),
+                 onFailure)
+
+  def writeTransform(self, transform, fileName, onFailure=None, compression=COMPRESSION_COMPRESSED):
+    snapshot = transform.CreateNodeInstance()
+    # Copy deep copies the transform (including bSpline coefficients) of transform nodes
+    snapshot.Copy(transform)
+    storageNode = snapshot.CreateDefaultStorageNode()
+    storageNode.SetUseCompression(compression != self.COMPRESSION_RAW)
+    self.enqueue(fileName, self._writeTransform, (snapshot, storageNode, fileName), onFailure)
+
+  def enqueue(self, fileName, function, arguments, onFailure=None):
+    self._pendingFileNames[fileName] = self._pendingFileNames.get(fileName, 0) + 1
+    self._tasks.put((fileName, function, arguments, onFailure))
+    if not self.resultTimer.isActive():
+      self.resultTimer.start()
+
+  def _processTasks(self):
+    while True:
+      fileName, function, arguments, onFailure = self._tasks.get()
+      try:
+        function(*arguments)
+        self._results.put((fileName, None, onFailure))
+      except Exception as exc:
+        self._results.put((fileName, exc, onFailure))
+      finally:
+        self._tasks.task_done()
+
+  @staticmethod
+  def _writeImageData(imageData, rasToIJK, fileName, compression=COMPRESSION_COMPRESSED, castToUnsignedChar=False):
+    if castToUnsignedChar:
+      cast = vtk.vtkImageCast()
+      cast.SetInputData(imageData)
+      cast.SetOutputScalarTypeToUnsignedChar()
+      cast.Update()
+      imageData = cast.GetOutput()
+    temporaryFileName = SnapshotWriter.getTemporaryFileName(fileName)
+    writer = slicer.vtkITKImageWriter()
+    writer.SetInputData(imageData)
+    writer.SetFileName(temporaryFileName)
+    writer.SetRasToIJKMatrix(rasToIJK)
+    writer.SetUseCompression(compression != SnapshotWriter.COMPRESSION_RAW)
+    writer.Write()
+    if not os.path.exists(temporaryFileName):
+      raise IOError("Writing %s failed" % fileName)
+    replaceFile(temporaryFileName, fileName)
+
+  @staticmethod
+  def _writeTransform(snapshot, storageNode, fileName):
+    temporaryFileName = SnapshotWriter.getTemporaryFileName(fileName)
+    storageNode.SetFileName(temporaryFileName)
+    if not storageNode.WriteData(snapshot) or not os.path.exists(temporaryFileName):
+      raise IOError("Writing %s failed" % fileName)
+    replaceFile(temporaryFileName, fileName)
+
+  @staticmethod
+  def getTemporaryFileName(fileName):
+    # next to the destination with the same extension, ITK picks the format by extension
+    root, extension = os.path.splitext(fileName)
+    return root + ".partial" + extension
+
+  def dispatchResults(self):
+    while True:
+      try:
+        fileName, exc, onFailure = self._results.get_nowait()
+      except Queue.Empty:
+        break
+      self._pendingFileNames[fileName] -= 1
+      if not self._pendingFileNames[fileName]:
+        del self._pendingFileNames[fileName]
+      if exc:
+        logging.error("Failed to write %s: %s" % (fileName, exc))
+        self._failedFileNames.append(fileName)
+        if onFailure:
+          onFailure(fileName)
+        self.invokeEvent(self.SnapshotWriteFailedEvent, fileName)
+      else:
+        self.invokeEvent(self.SnapshotWrittenEvent, fileName)
+    if not self.hasPendingWrites():
+      self.resultTimer.stop()
+
+  def flush(self):
+    """ Blocks until all queued writes finished and returns the files which failed since the last flush """
+    self._tasks.join()
+    self.dispatchResults()
+    failedFileNames = self._failedFileNames
+    self._failedFileNames = []
+    return failedFileNames
@@ -12,7 +12,7 @@ from plugins.training import SliceTrackerTrainingPlugin
 from plugins.charts import SliceTrackerDisplacementChartPlugin
 from ..constants import SliceTrackerConstants as constants
 from ..sessionData import RegistrationResult
-from ..helpers import IncomingDataMessageBox, SeriesTypeToolButton, SeriesTypeManager
+from ..helpers import IncomingDataMessageBox, SeriesTypeToolButton
 
 from SlicerDevelopmentToolboxUtils.constants import COLOR
 from SlicerDevelopmentToolboxUtils.widgets import CustomStatusProgressbar
@@ -310,25 +310,20 @@ class SliceTrackerOverviewStep(SliceTrackerStep):
 
   def selectMostRecentEligibleSeries(self):
     substring = self.getSetting("NEEDLE_IMAGE_PATTERN")
-    seriesTypeManager = SeriesTypeManager()
     self.intraopSeriesSelector.blockSignals(True)
     self.intraopSeriesSelector.setCurrentIndex(-1)
     self.intraopSeriesSelector.blockSignals(False)
-    index = -1
     if not self.session.data.getMostRecentApprovedCoverProstateRegistration():
       substring = self.getSetting("COVER_TEMPLATE_PATTERN") \
         if not self.session.zFrameRegistrationSuccessful else self.getSetting("COVER_PROSTATE_PATTERN")
-    for item in list(reversed(range(len(self.session.seriesList)))):
-      series = self._seriesModel.item(item).text()
-      if substring in seriesTypeManager.getSeriesType(series):
-        if index != -1:
-          if self.session.data.registrationResultWasApprovedOrRejected(series) or \
-            self.session.data.registrationResultWasSkipped(series):
-            break
-        index = self.intraopSeriesSelector.findText(series)
-        break
-      elif self.session.seriesTypeManager.isVibe(series) and index == -1:
-        index = self.intraopSeriesSelector.findText(series)
+    seriesList = self.session.seriesList
+    series = seriesList.getMostRecentSeriesForTypeSubstring(substring)
+    vibeSeries = seriesList.getSeriesByType(constants.VIBE_IMAGE)
+    if vibeSeries and (not series or seriesList.getRecord(vibeSeries[-1]).number > seriesList.getRecord(series).number):
+      if not series or self.session.data.registrationResultWasApprovedOrRejected(series) or \
+        self.session.data.registrationResultWasSkipped(series):
+        series = vibeSeries[-1]
+    index = self.intraopSeriesSelector.findText(series) if series else -1
     rowCount = self.intraopSeriesSelector.model().rowCount()
 
     self.intraopSeriesSelector.setCurrentIndex(index if index != -1 else (rowCount-1 if rowCount else -1))
@@ -33,8 +33,7 @@ class SliceTrackerDisplacementChartLogic(SliceTrackerLogicBase):
                                   self.session.data.registrationResultWasRejected(selectedSeries):
       return False
     selectedSeriesNumber = RegistrationResult.getSeriesNumberFromString(selectedSeries)
-    approvedResults = sorted([r for r in self.session.data.registrationResults.values() if r.approved],
-                             key=lambda result: result.seriesNumber)
+    approvedResults = self.session.data.getApprovedResults()
     nonSelectedApprovedResults = filter(lambda x: x.seriesNumber != selectedSeriesNumber, approvedResults)
     if len(nonSelectedApprovedResults) == 0 or self.session.currentResult is None:
       return False
@@ -196,8 +195,7 @@ class SliceTrackerDisplacementChartPlugin(SliceTrackerPlugin):
   def updateTargetDisplacementChart(self, targetsAvailable):
     if self.logic.isTargetDisplacementChartDisplayable(self.session.currentSeries) and targetsAvailable:
       self.resetChart()
-      results = sorted([r for r in self.session.data.registrationResults.values() if r.approved],
-                       key=lambda result: result.seriesNumber)
+      results = self.session.data.getApprovedResults()
       if not self.session.currentResult.wasEvaluated():
         results.append(self.session.currentResult)
       for currIndex, currResult in enumerate(results[1:], 1):
@@ -196,7 +196,7 @@ class SliceTrackerRegistrationResultsPlugin(SliceTrackerPlugin):
 
   def updateAvailableRegistrationButtons(self):
     for button in self.registrationButtonGroup.buttons():
-      volume = self.currentResult.volumes.asDict()[button.name]
+      volume = getattr(self.currentResult.volumes, button.name)
       button.enabled = volume and self.logic.isVolumeExtentValid(volume)
       button.checked = False
 
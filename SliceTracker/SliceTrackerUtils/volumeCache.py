@@ -0,0 +1,67 @@
+import logging
+import slicer
+from collections import OrderedDict
+
+
+class LoadedVolumeCache(object):
+  """ Least recently used cache of loaded series volumes limited by the memory size of their image data """
+
+  @staticmethod
+  def getVolumeSize(volume):
+    imageData = volume.GetImageData()
+    return imageData.GetActualMemorySize() * 1024 if imageData else 0
+
+  def __init__(self, budget, isPinned=None):
+    self.budget = budget
+    self.isPinned = isPinned if isPinned else lambda series, volume: False
+    self._volumes = OrderedDict()
+
+  def __contains__(self, series):
+    return series in self._volumes
+
+  def __len__(self):
+    return len(self._volumes)
+
+  def __getitem__(self, series):
+    volume, fileCount = self._volumes.pop(series)
+    self._volumes[series] = (volume, fileCount)
+    return volume
+
+  def getFileCount(self, series):
+    try:
+      return self._volumes[series][1]
+    except KeyError:
+      return None
+
+  def add(self, series, volume, fileCount):
+    self._volumes.pop(series, None)
+    self._volumes[series] = (volume, fileCount)
+    self.evict(keep=series)
+
+  def pop(self, series):
+    try:
+      return self._volumes.pop(series)[0]
+    except KeyError:
+      return None
+
+  def clear(self):
+    self._volumes = OrderedDict()
+
+  def getSize(self):
+    return sum(self.getVolumeSize(volume) for volume, _ in self._volumes.values())
+
+  def evict(self, keep=None):
+    size = self.getSize()
+    evicted = []
+    for series in list(self._volumes.keys()):
+      if size <= self.budget:
+        break
+      volume, _ = self._volumes[series]
+      if series == keep or self.isPinned(series, volume):
+        continue
+      logging.debug("Evicting volume of series %s from loaded volume cache" % series)
+      del self._volumes[series]
+      size -= self.getVolumeSize(volume)
+      slicer.mrmlScene.RemoveNode(volume)
+      evicted.append(series)
+    return evicted
@@ -2,67 +2,361 @@ __author__ = 'Christian'
 
 import sys, getopt, os, dicom
 import time
+import sqlite3
+import threading
+import Queue
+import subprocess
+from collections import OrderedDict
+from dicom.tag import Tag
+from dicom.filereader import read_partial
+
+try:
+  import pyinotify
+except ImportError:
+  pyinotify = None
 
 class NotDirectoryError(Exception):
   pass
 
+class DICOMFileValidator(object):
+  """ Results are memoized by device, inode, size and modification time """
+
+  PREAMBLE_LENGTH = 128
+  MAGIC = "DICM"
+
+  def __init__(self, parseHeader=False):
+    self.parseHeader = parseHeader
+    self._results = {}
+
+  def isDICOMFile(self, fileName):
+    try:
+      fileStat = os.stat(fileName)
+    except OSError:
+      return False
+    key = (fileStat.st_dev, fileStat.st_ino, fileStat.st_size, fileStat.st_mtime)
+    try:
+      return self._results[key]
+    except KeyError:
+      result = self._results[key] = self.validate(fileName)
+      return result
+
+  def validate(self, fileName):
+    try:
+      with open(fileName, 'rb') as f:
+        f.seek(self.PREAMBLE_LENGTH)
+        if f.read(len(self.MAGIC)) != self.MAGIC:
+          return False
+    except IOError:
+      return False
+    if self.parseHeader:
+      try:
+        dicom.read_file(fileName, stop_before_pixels=True)
+      except Exception as exc:
+        print "Skipping %s: %s" % (fileName, exc)
+        return False
+    return True
+
+
+class StoreSCUSender(object):
+  """ Sends the files of one send call over a single storescu association (chunked for long file lists) """
+
+  MAXIMUM_FILES_PER_ASSOCIATION = 500
+
+  def __init__(self, host, port, calledAETitle="ANY-SCP", callingAETitle="STORESCU", runner=subprocess.call):
+    self.host = host
+    self.port = port
+    self.calledAETitle = calledAETitle
+    self.callingAETitle = callingAETitle
+    self.runner = runner
+
+  def getCommand(self, files):
+    return ['storescu', '-aet', self.callingAETitle, '-aec', self.calledAETitle, self.host, str(self.port)] + files
+
+  def send(self, files):
+    success = True
+    for start in range(0, len(files), self.MAXIMUM_FILES_PER_ASSOCIATION):
+      cmd = self.getCommand(files[start:start + self.MAXIMUM_FILES_PER_ASSOCIATION])
+      print ' '.join(cmd[:7]), '<%d files>' % (len(cmd) - 7)
+      success = self.runner(cmd) == 0 and success
+    return success
+
+
+class SendStateStore(object):
+  """ A file counts as sent only for the size and modification time it had when it was sent """
+
+  SENT = "sent"
+  FAILED = "failed"
+
+  RETRY_BASE_DELAY = 2
+  RETRY_MAXIMUM_DELAY = 60
+
+  def __init__(self, databaseFile):
+    self.connection = sqlite3.connect(databaseFile)
+    self.connection.text_factory = str
+    self.connection.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, "
+                            "status TEXT, attempts INTEGER, nextAttempt REAL)")
+    self.connection.commit()
+
+  def _getStat(self, fileName):
+    fileStat = os.stat(fileName)
+    return fileStat.st_size, fileStat.st_mtime
+
+  def isSent(self, fileName):
+    row = self.connection.execute("SELECT size, mtime FROM files WHERE path=? AND status=?",
+                                  (fileName, self.SENT)).fetchone()
+    try:
+      return row is not None and tuple(row) == self._getStat(fileName)
+    except OSError:
+      return False
+
+  def markSent(self, files):
+    for fileName in files:
+      try:
+        size, mtime = self._getStat(fileName)
+      except OSError:
+        continue
+      self.connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, 0, NULL)",
+                              (fileName, size, mtime, self.SENT))
+    self.connection.commit()
+
+  def markFailed(self, files):
+    for fileName in files:
+      row = self.connection.execute("SELECT attempts FROM files WHERE path=? AND status=?",
+                                    (fileName, self.FAILED)).fetchone()
+      attempts = row[0] + 1 if row else 1
+      delay = min(self.RETRY_BASE_DELAY * 2 ** (attempts - 1), self.RETRY_MAXIMUM_DELAY)
+      self.connection.execute("INSERT OR REPLACE INTO files VALUES (?, NULL, NULL, ?, ?, ?)",
+                              (fileName, self.FAILED, attempts, time.time() + delay))
+    self.connection.commit()
+
+  def getFilesToRetry(self, now=None):
+    now = now if now is not None else time.time()
+    return [row[0] for row in self.connection.execute("SELECT path FROM files WHERE status=? AND nextAttempt<=? "
+                                                      "ORDER BY path", (self.FAILED, now))]
+
+  def removeFiles(self, files):
+    for fileName in files:
+      self.connection.execute("DELETE FROM files WHERE path=?", (fileName,))
+    self.connection.commit()
+
+  def getFailedFiles(self):
+    return [row[0] for row in self.connection.execute("SELECT path FROM files WHERE status=?", (self.FAILED,))]
+
+  def close(self):
+    self.connection.commit()
+    self.connection.close()
+
+
 class DICOMDirectoryObserver(object):
+  SERIES_INSTANCE_UID = Tag(0x0020, 0x000E)
+  STATE_FILE_NAME = ".watchSendState.db"
 
-  def __init__(self, directory, host, port):
+  def __init__(self, directory, host, port, calledAETitle="ANY-SCP", callingAETitle="STORESCU",
+               numberOfAssociations=2, stateFile=None, parseHeaders=False, runner=subprocess.call):
     if not os.path.isdir(directory):
       raise NotDirectoryError("The directory is actually no directory")
     self.directory = directory
     self.host = host
     self.port = port
-    self.files = set()
+    self.sender = StoreSCUSender(host, port, calledAETitle=calledAETitle, callingAETitle=callingAETitle,
+                                 runner=runner)
+    self.validator = DICOMFileValidator(parseHeader=parseHeaders)
+    self.state = SendStateStore(stateFile if stateFile else os.path.join(directory, self.STATE_FILE_NAME))
+    self.sendQueue = Queue.Queue()
+    self.resultQueue = Queue.Queue()
+    self.senderThreads = []
+    for _ in range(numberOfAssociations):
+      thread = threading.Thread(target=self.sendFromQueue)
+      thread.daemon = True
+      thread.start()
+      self.senderThreads.append(thread)
+    self.files = set(self.state.getFailedFiles())
+    self.sendingFiles = set()
+    self.snapshot = {}
+    self.checkedFiles = {}
+    self.pendingFiles = set()
+
+  @staticmethod
+  def isEventWatchingSupported():
+    return pyinotify is not None and sys.platform.startswith('linux')
+
+  def isDICOMFile(self, fileName):
+    return self.validator.isDICOMFile(fileName)
 
   def listdirRecursive(self, rootDir):
-    files = []
+    return [fileName for fileName in sorted(self.takeSnapshot(rootDir).keys()) if self.isDICOMFile(fileName)]
+
+  def takeSnapshot(self, rootDir):
+    snapshot = {}
     for root, subFolders, dirFiles in os.walk(rootDir):
       for f in dirFiles:
+        if f.startswith("."):
+          continue
+        fileName = os.path.join(root, f)
         try:
-          fileName = os.path.join(root,f)
-          dicom.read_file(fileName)
-          files.append(fileName)
-        except:
-          pass
-    return files
-
-  def watch(self, secondsToWait=1):
+          fileStat = os.stat(fileName)
+        except OSError:
+          continue
+        snapshot[fileName] = (fileStat.st_size, fileStat.st_mtime)
+    return snapshot
+
+  def getStableUncheckedFiles(self):
+    # only files which did not change since the last snapshot are considered to be completely written
+    snapshot = self.takeSnapshot(self.directory)
+    stableFiles = [fileName for fileName, fileStat in snapshot.iteritems()
+                   if self.snapshot.get(fileName) == fileStat and self.checkedFiles.get(fileName) != fileStat]
+    for fileName in stableFiles:
+      self.checkedFiles[fileName] = snapshot[fileName]
+    self.snapshot = snapshot
+    return sorted(stableFiles)
+
+  def watch(self, secondsToWait=1, poll=False):
+    if poll or not self.isEventWatchingSupported():
+      print "Watching directory by polling every %s second(s)" % secondsToWait
+      self.poll(secondsToWait)
+    else:
+      print "Watching directory for inotify close-write/moved-to events"
+      self.watchEvents(secondsToWait)
+
+  def poll(self, secondsToWait=1):
     while True:
-      currentFiles = self.listdirRecursive(self.directory)
-      if len(self.files) < len(currentFiles):
+      newFiles = [f for f in self.getStableUncheckedFiles() if self.isUnsentDICOMFile(f)]
+      if len(newFiles):
         print "Number of files changed"
-        for newFile in self.getNewFiles(currentFiles):
-          self.storeSCU(newFile)
+        self.sendFiles(newFiles)
+      self.processSendResults()
+      self.retryFailedFiles()
       time.sleep(secondsToWait)
 
-  def getNewFiles(self, files):
-    newFiles = []
-    for currentFile in files:
-      if currentFile not in self.files:
-        newFiles.append(currentFile)
-    return newFiles
+  def watchEvents(self, secondsToWait=1):
+    observer = self
+
+    class EventHandler(pyinotify.ProcessEvent):
+
+      def process_IN_CLOSE_WRITE(self, event):
+        observer.onFileWritten(event.pathname)
+
+      def process_IN_MOVED_TO(self, event):
+        observer.onFileWritten(event.pathname)
+
+    watchManager = pyinotify.WatchManager()
+    notifier = pyinotify.Notifier(watchManager, EventHandler())
+    watchManager.add_watch(self.directory, pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO, rec=True, auto_add=True)
+    self.sendFiles([f for f in sorted(self.takeSnapshot(self.directory).keys()) if self.isUnsentDICOMFile(f)])
+    try:
+      while True:
+        if notifier.check_events(timeout=int(secondsToWait * 1000)):
+          notifier.read_events()
+          notifier.process_events()
+        self.sendPendingFiles()
+        self.processSendResults()
+        self.retryFailedFiles()
+    finally:
+      notifier.stop()
+
+  def onFileWritten(self, fileName):
+    if not os.path.basename(fileName).startswith(".") and os.path.isfile(fileName) and \
+        self.isUnsentDICOMFile(fileName):
+      self.pendingFiles.add(fileName)
+
+  def isUnsentDICOMFile(self, fileName):
+    return fileName not in self.files and not self.state.isSent(fileName) and self.isDICOMFile(fileName)
+
+  def sendPendingFiles(self):
+    if len(self.pendingFiles):
+      print "Number of files changed"
+      pendingFiles = sorted(self.pendingFiles)
+      self.pendingFiles.clear()
+      self.sendFiles(pendingFiles)
+
+  def getSeriesInstanceUID(self, fileName):
+    try:
+      with open(fileName, 'rb') as f:
+        dataset = read_partial(f, stop_when=lambda tag, VR, length: tag > self.SERIES_INSTANCE_UID)
+      return dataset[self.SERIES_INSTANCE_UID].value
+    except Exception:
+      return None
+
+  def groupFilesBySeries(self, files):
+    seriesFiles = OrderedDict()
+    for fileName in files:
+      seriesFiles.setdefault(self.getSeriesInstanceUID(fileName), []).append(fileName)
+    return seriesFiles
+
+  def sendFiles(self, files):
+    self.files.update(files)
+    self.sendingFiles.update(files)
+    for seriesInstanceUID, seriesFiles in self.groupFilesBySeries(files).iteritems():
+      self.sendQueue.put((seriesInstanceUID, seriesFiles))
+
+  def sendFromQueue(self):
+    while True:
+      seriesInstanceUID, files = self.sendQueue.get()
+      try:
+        success = self.storeSCU(files, seriesInstanceUID)
+      except Exception as exc:
+        print "Sending series %s failed: %s" % (seriesInstanceUID, exc)
+        success = False
+      self.resultQueue.put((files, success))
+      self.sendQueue.task_done()
+
+  def storeSCU(self, files, seriesInstanceUID=None):
+    start = time.time()
+    success = self.sender.send(files)
+    seconds = time.time() - start
+    print "%s %d file(s) of series %s in %.2fs (%.1f files/s)" % ("Sent" if success else "Failed to send", len(files),
+                                                                 seriesInstanceUID, seconds,
+                                                                 len(files) / seconds if seconds else 0)
+    return success
+
+  def processSendResults(self):
+    while True:
+      try:
+        files, success = self.resultQueue.get_nowait()
+      except Queue.Empty:
+        break
+      self.sendingFiles.difference_update(files)
+      if success:
+        self.state.markSent(files)
+      else:
+        self.state.markFailed(files)
+
+  def retryFailedFiles(self):
+    files = [f for f in self.state.getFilesToRetry() if f not in self.sendingFiles]
+    self.state.removeFiles([f for f in files if not os.path.isfile(f)])
+    files = [f for f in files if os.path.isfile(f)]
+    if len(files):
+      print "Retrying %d file(s)" % len(files)
+      self.sendFiles(files)
 
-  def storeSCU(self, fileName):
-    cmd = ('storescu ' + self.host + ' ' + self.port + ' ' + fileName)
-    print cmd
-    os.system(cmd)
-    self.files.add(fileName)
+  def flush(self):
+    self.sendQueue.join()
+    self.processSendResults()
 
 def main(argv):
    watchDirectory = ''
    host = 'localhost'
    port = '11112'
    interval = 1
+   poll = False
+   calledAETitle = "ANY-SCP"
+   callingAETitle = "STORESCU"
+   numberOfAssociations = 2
+   stateFile = None
+   parseHeaders = False
+   usage = 'watch.py -d <watchDirectory> -h <host> -p <port> -i <interval [in seconds]> [--aec <called AE title>] ' \
+           '[--aet <calling AE title>] [--associations <number of parallel associations>] ' \
+           '[--state <send state database>] [--parse-headers] [--poll]'
    try:
-      opts, args = getopt.getopt(argv,"i:d:h:p:?",["help","directory=","host=","port=","interval="])
+      opts, args = getopt.getopt(argv,"i:d:h:p:?",["help","directory=","host=","port=","interval=","poll","aec=",
+                                                     "aet=","associations=","state=",
+                                                     "parse-headers"])
    except getopt.GetoptError:
-      print 'watch.py -d <watchDirectory> -h <host> -p <port> -i <interval [in seconds]>'
+      print usage
       sys.exit(2)
    for opt, arg in opts:
       if opt in ("-?", "--help"):
-         print 'watch.py -d <watchDirectory> -h <host> -p <port>'
+         print usage
          sys.exit()
       elif opt in ("-d", "--directory"):
          watchDirectory = arg
@@ -72,18 +366,38 @@ def main(argv):
          port = arg
       elif opt in ("-i", "--interval"):
          interval = int(arg)
+      elif opt == "--poll":
+         poll = True
+      elif opt == "--aec":
+         calledAETitle = arg
+      elif opt == "--aet":
+         callingAETitle = arg
+      elif opt == "--associations":
+         numberOfAssociations = int(arg)
+      elif opt == "--state":
+         stateFile = arg
+      elif opt == "--parse-headers":
+         parseHeaders = True
    if watchDirectory and host and port:
      print 'Directory to watch is: ', watchDirectory
      print 'Host to send DICOM files to is: ', host
      print 'Port to send DICOM files to is: ', port
+     print 'Called/calling AE title: ', calledAETitle, callingAETitle
 
-     watcher = DICOMDirectoryObserver(directory=watchDirectory, host=host, port=port)
+     watcher = DICOMDirectoryObserver(directory=watchDirectory, host=host, port=port, calledAETitle=calledAETitle,
+                                      callingAETitle=callingAETitle, numberOfAssociations=numberOfAssociations,
+                                      stateFile=stateFile, parseHeaders=parseHeaders)
      print "Will watch!"
-     watcher.watch(interval)
+     watcher.watch(interval, poll=poll)
 
 if __name__ == "__main__":
    main(sys.argv[1:])
 
 
 #client use:  $ sudo storescp -v -p 104
+#local stand-in receiver:  $ storescp -v -aet SLICETRACKER -od /tmp/received 11112
+#python watch.py -d "/Users/Christian/Documents/TEST1" -h localhost -p 11112 --aec SLICETRACKER
 #python watch.py -d "/Users/Christian/Documents/TEST1" -h localhost -p 104 -i 1
+#python watch.py -d "/Users/Christian/Documents/TEST1" -h localhost -p 104 -i 1 --poll   (stat based polling)
+#python watch.py -d "/Users/Christian/Documents/TEST1" -h localhost -p 104 --associations 4   (restarts resume from
+#  the send state kept in <watchDirectory>/.watchSendState.db unless --state is given)
@@ -0,0 +1,391 @@
+import os, sys, json, time
+import getopt
+import shutil, tempfile
+import numpy
+import vtk, ctk
+import slicer
+from vtk.util import numpy_support
+
+from dicom.dataset import Dataset, FileDataset
+from dicom.UID import generate_uid
+
+from SlicerDevelopmentToolboxUtils.constants import DICOMTAGS
+from SlicerDevelopmentToolboxUtils.mixins import ModuleLogicMixin
+from SliceTrackerUtils.dicomHeaderIndex import DICOMHeaderReader
+from SliceTrackerUtils.session import SliceTrackerSession
+from SliceTrackerUtils.sessionData import IncrementalSaveMixin
+from SliceTrackerUtils.snapshotWriter import SnapshotWriter
+
+__all__ = ['benchmarkDICOMHeaderReading', 'generateSyntheticCase', 'benchmarkIngestion', 'benchmarkCompression',
+           'benchmarkSynchronousWrites']
+
+# usage: Slicer --no-main-window --python-script SliceTrackerBenchmarks.py [options]
+#
+#  -d, --directory <DICOM directory>   compare per-tag lookups against DICOMHeaderReader for existing DICOM data
+#  -s, --sizes <n,n,...>               number of synthetic intraop files per ingestion run (e.g. 1000,10000,50000)
+#  --slices <n>                        number of slices per synthetic series (default: 50)
+#  --patients <n>                      number of different patients within the synthetic study (default: 1)
+#  -c, --compression <n>               save and load a synthetic case of n registration results with every
+#                                      compression profile
+#  -w, --writes <n>                    time the .fcsv and .vtk files which are still written on the main thread for
+#                                      n targets and a segmentation model
+#  -o, --output <output.json>          write the machine-readable results to a file
+
+
+def listFilesRecursive(directory):
+  files = []
+  for root, _, fileNames in os.walk(directory):
+    files += [os.path.join(root, f) for f in fileNames if f != ".DS_Store"]
+  return files
+
+
+class Timer(object):
+
+  def __enter__(self):
+    self.start = time.time()
+    return self
+
+  def __exit__(self, *args):
+    self.seconds = time.time() - self.start
+
+
+def benchmarkDICOMHeaderReading(directory):
+  """ Compares the former per-tag lookups against reading all needed tags in one pass with DICOMHeaderReader """
+  files = listFilesRecursive(directory)
+  tags = [DICOMTAGS.SERIES_NUMBER, DICOMTAGS.SERIES_DESCRIPTION, DICOMTAGS.PATIENT_ID, DICOMTAGS.PATIENT_NAME]
+
+  with Timer() as perTagTimer:
+    for f in files:
+      for tag in tags:
+        ModuleLogicMixin.getDICOMValue(f, tag)
+
+  reader = DICOMHeaderReader()
+  with Timer() as readerTimer:
+    for f in files:
+      reader.readValues(f)
+
+  return {
+    "files": len(files),
+    "tags": len(tags),
+    "perTagLookupSeconds": perTagTimer.seconds,
+    "headerReaderSeconds": readerTimer.seconds,
+    "speedup": perTagTimer.seconds / readerTimer.seconds if readerTimer.seconds else None
+  }
+
+
+SYNTHETIC_SERIES_DESCRIPTIONS = ["COVER TEMPLATE", "COVER PROSTATE", "GUIDANCE", "GUIDANCE", "VIBE", "GUIDANCE"]
+
+
+def writeSyntheticSlice(fileName, patientIndex, studyUID, seriesUID, seriesNumber, seriesDescription, sliceIndex,
+                        numberOfSlices, rows, columns):
+  meta = Dataset()
+  meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+  meta.MediaStorageSOPInstanceUID = generate_uid()
+  meta.TransferSyntaxUID = '1.2.840.10008.1.2'
+  meta.ImplementationClassUID = generate_uid()
+
+  ds = FileDataset(fileName, {}, file_meta=meta, preamble="\0" * 128)
+  ds.is_little_endian = True
+  ds.is_implicit_VR = True
+  ds.SOPClassUID = meta.MediaStorageSOPClassUID
+  ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+  ds.Modality = "MR"
+  ds.PatientName = "SliceTracker^Synthetic%d" % patientIndex
+  ds.PatientID = "ST-SYNTHETIC-%03d" % patientIndex
+  ds.StudyInstanceUID = studyUID
+  ds.SeriesInstanceUID = seriesUID
+  ds.FrameOfReferenceUID = studyUID + ".1"
+  ds.StudyDate = time.strftime("%Y%m%d")
+  ds.SeriesNumber = seriesNumber
+  ds.SeriesDescription = seriesDescription
+  ds.InstanceNumber = sliceIndex + 1
+  ds.ImagesInAcquisition = numberOfSlices
+  ds.ImagePositionPatient = [0.0, 0.0, float(sliceIndex) * 3.0]
+  ds.ImageOrientationPatient = [1.0, 0.0, 0.0, 0.0, 1.0, 0.0]
+  ds.PixelSpacing = [0.5, 0.5]
+  ds.SliceThickness = 3.0
+  ds.SamplesPerPixel = 1
+  ds.PhotometricInterpretation = "MONOCHROME2"
+  ds.Rows = rows
+  ds.Columns = columns
+  ds.BitsAllocated = 16
+  ds.BitsStored = 16
+  ds.HighBit = 15
+  ds.PixelRepresentation = 0
+  ds.PixelData = numpy.random.randint(0, 1024, size=(rows, columns)).astype(numpy.uint16).tostring()
+  ds.save_as(fileName)
+
+
+def generateSyntheticCase(directory, numberOfFiles, slicesPerSeries=50, numberOfPatients=1, rows=64, columns=64):
+  """ Writes a synthetic intraop study of numberOfFiles DICOM files into directory and returns the file names
+
+  Series descriptions cycle through the SliceTracker series types and consecutive series are spread across
+  numberOfPatients patients.
+  """
+  if not os.path.exists(directory):
+    os.makedirs(directory)
+  studyUIDs = [generate_uid() for _ in range(numberOfPatients)]
+  files = []
+  seriesNumber = 0
+  while len(files) < numberOfFiles:
+    seriesNumber += 1
+    patientIndex = seriesNumber % numberOfPatients
+    seriesUID = generate_uid()
+    seriesDescription = SYNTHETIC_SERIES_DESCRIPTIONS[(seriesNumber - 1) % len(SYNTHETIC_SERIES_DESCRIPTIONS)]
+    numberOfSlices = min(slicesPerSeries, numberOfFiles - len(files))
+    for sliceIndex in range(numberOfSlices):
+      fileName = os.path.join(directory, "%05d-%05d.dcm" % (seriesNumber, sliceIndex))
+      writeSyntheticSlice(fileName, patientIndex, studyUIDs[patientIndex], seriesUID, seriesNumber,
+                          seriesDescription, sliceIndex, numberOfSlices, rows, columns)
+      files.append(fileName)
+  return files
+
+
+def benchmarkIngestion(numberOfFiles, slicesPerSeries=50, numberOfPatients=1, keepData=False):
+  """ Times the intraop ingestion of a synthetic case of numberOfFiles files through SliceTrackerSession
+
+  A new case is created in a temporary directory and the synthetic files are imported with importDICOMSeries, which
+  reads the headers, indexes the files and assembles the completed series. slicer.dicomDatabase is replaced by a
+  temporary ctkDICOMDatabase so that the application database does not get filled with synthetic data. Patient
+  mismatches are confirmed automatically.
+  """
+  tempDirectory = tempfile.mkdtemp(prefix="SliceTrackerBenchmark")
+  session = SliceTrackerSession()
+  applicationDatabase = slicer.dicomDatabase
+  confirmYesNoDisplay = slicer.util.confirmYesNoDisplay
+  database = ctk.ctkDICOMDatabase()
+  database.openDatabase(os.path.join(tempDirectory, "ctkDICOM.sql"), "SliceTrackerBenchmark")
+  stageSeconds = {}
+
+  def timed(stage, function):
+    def wrapper(*args, **kwargs):
+      start = time.time()
+      try:
+        return function(*args, **kwargs)
+      finally:
+        stageSeconds[stage] = stageSeconds.get(stage, 0) + time.time() - start
+    return wrapper
+
+  try:
+    session.createNewCase(os.path.join(tempDirectory, "Case"))
+    with Timer() as generationTimer:
+      files = generateSyntheticCase(session.intraopDICOMDirectory, numberOfFiles, slicesPerSeries, numberOfPatients)
+
+    slicer.dicomDatabase = database
+    slicer.util.confirmYesNoDisplay = lambda *args, **kwargs: True
+    session.headerIndex.addFiles = timed("headerIndexing", session.headerIndex.addFiles)
+    session.collectCompletedSeries = timed("seriesAssembly", session.collectCompletedSeries)
+    session.verifyPatientIDEquality = timed("patientVerification", session.verifyPatientIDEquality)
+    with Timer() as importTimer:
+      session.importDICOMSeries([os.path.basename(f) for f in files])
+    session.resetPrefetchTimer()
+
+    with Timer() as volumeTimer:
+      volume = session.getOrCreateVolumeForSeries(session.seriesList[len(session.seriesList) - 1])
+
+    return {
+      "files": len(files),
+      "series": len(session.seriesList),
+      "slicesPerSeries": slicesPerSeries,
+      "patients": numberOfPatients,
+      "generationSeconds": generationTimer.seconds,
+      "importSeconds": importTimer.seconds,
+      "headerIndexingSeconds": stageSeconds.get("headerIndexing", 0),
+      "databaseIndexingSeconds": importTimer.seconds - sum(stageSeconds.values()),
+      "seriesAssemblySeconds": stageSeconds.get("seriesAssembly", 0),
+      "patientVerificationSeconds": stageSeconds.get("patientVerification", 0),
+      "volumeLoadSeconds": volumeTimer.seconds,
+      "importFilesPerSecond": len(files) / importTimer.seconds if importTimer.seconds else None
+    }
+  finally:
+    slicer.dicomDatabase = applicationDatabase
+    slicer.util.confirmYesNoDisplay = confirmYesNoDisplay
+    for method in ["collectCompletedSeries", "verifyPatientIDEquality"]:
+      session.__dict__.pop(method, None)
+    session.close(save=False)
+    database.closeDatabase()
+    if not keepData:
+      shutil.rmtree(tempDirectory, ignore_errors=True)
+
+
+class ProfileSaver(IncrementalSaveMixin):
+
+  def __init__(self, compression):
+    self.compression = compression
+
+  def getCompressionProfile(self, node):
+    return self.compression
+
+
+def createSyntheticCaseNodes(numberOfResults, dimensions=(256, 256, 30)):
+  """ Creates the volumes, labels and bSpline transforms of numberOfResults synthetic registration results """
+  columns, rows, slices = dimensions
+  nodes = []
+  k, j, i = numpy.mgrid[0:slices, 0:rows, 0:columns]
+  distance = ((i - columns / 2.0) / (columns / 4.0)) ** 2 + ((j - rows / 2.0) / (rows / 5.0)) ** 2 + \
+             ((k - slices / 2.0) / (slices / 3.0)) ** 2
+  for index in range(numberOfResults):
+    for name, volumeClass, voxels in [
+        ("%d-fixed" % index, slicer.vtkMRMLScalarVolumeNode,
+         (400 + 300 * (distance < 1) + numpy.random.normal(0, 30, distance.shape)).astype(numpy.int16)),
+        ("%d-label" % index, slicer.vtkMRMLLabelMapVolumeNode, (distance < 1).astype(numpy.int16))]:
+      imageData = vtk.vtkImageData()
+      imageData.SetDimensions(columns, rows, slices)
+      imageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(voxels.ravel(), deep=True,
+                                                                     array_type=vtk.VTK_SHORT))
+      volume = volumeClass()
+      volume.SetName(name)
+      volume.SetSpacing(0.5, 0.5, 3.0)
+      volume.SetAndObserveImageData(imageData)
+      slicer.mrmlScene.AddNode(volume)
+      nodes.append((volume, ".nrrd"))
+    coefficients = vtk.vtkImageData()
+    coefficients.SetDimensions(14, 14, 14)
+    coefficients.AllocateScalars(vtk.VTK_DOUBLE, 3)
+    numpy_support.vtk_to_numpy(coefficients.GetPointData().GetScalars())[:] = \
+      numpy.random.normal(0, 2, (14 * 14 * 14, 3))
+    bSpline = slicer.vtkOrientedBSplineTransform()
+    bSpline.SetCoefficientData(coefficients)
+    transform = slicer.vtkMRMLBSplineTransformNode()
+    transform.SetName("%d-bSpline" % index)
+    transform.SetAndObserveTransformFromParent(bSpline)
+    slicer.mrmlScene.AddNode(transform)
+    nodes.append((transform, ".h5"))
+  return nodes
+
+
+def benchmarkCompression(numberOfResults=4, profiles=None):
+  """ Times saving and loading a synthetic case with each compression profile and reports the bytes written """
+  profiles = profiles if profiles else SnapshotWriter.COMPRESSION_PROFILES
+  nodes = createSyntheticCaseNodes(numberOfResults)
+  tempDirectory = tempfile.mkdtemp(prefix="SliceTrackerBenchmark")
+  results = []
+  try:
+    for profile in profiles:
+      directory = os.path.join(tempDirectory, profile)
+      os.makedirs(directory)
+      saver = ProfileSaver(profile)
+      with Timer() as saveTimer:
+        for node, extension in nodes:
+          saver.saveNodeDataIfModified(node, directory, extension)
+        failed = SnapshotWriter().flush()
+      fileNames = [os.path.join(directory, node.GetName() + extension) for node, extension in nodes]
+      with Timer() as loadTimer:
+        for (node, extension), fileName in zip(nodes, fileNames):
+          if isinstance(node, slicer.vtkMRMLLabelMapVolumeNode):
+            _, loaded = slicer.util.loadLabelVolume(fileName, returnNode=True)
+          elif isinstance(node, slicer.vtkMRMLVolumeNode):
+            _, loaded = slicer.util.loadVolume(fileName, returnNode=True)
+          else:
+            _, loaded = slicer.util.loadTransform(fileName, returnNode=True)
+          slicer.mrmlScene.RemoveNode(loaded)
+      results.append({
+        "profile": profile,
+        "results": numberOfResults,
+        "files": len(fileNames),
+        "failed": len(failed),
+        "saveSeconds": saveTimer.seconds,
+        "loadSeconds": loadTimer.seconds,
+        "bytes": sum(os.path.getsize(f) for f in fileNames if os.path.exists(f)),
+        "bytesPerType": dict((extension, sum(os.path.getsize(f) for (n, e), f in zip(nodes, fileNames)
+                                             if e == extension and os.path.exists(f)))
+                             for extension in set(e for _, e in nodes))
+      })
+  finally:
+    for node, _ in nodes:
+      slicer.mrmlScene.RemoveNode(node)
+    shutil.rmtree(tempDirectory, ignore_errors=True)
+  return results
+
+
+def benchmarkSynchronousWrites(numberOfTargets=20, modelResolution=256, repetitions=5):
+  """ Times the targets (.fcsv) and segmentation model (.vtk) writes which are not handed to the SnapshotWriter """
+  targets = slicer.vtkMRMLMarkupsFiducialNode()
+  targets.SetName("targets")
+  slicer.mrmlScene.AddNode(targets)
+  for index in range(numberOfTargets):
+    targets.AddFiducial(index, -index, 2 * index, "Target %d" % index)
+  sphere = vtk.vtkSphereSource()
+  sphere.SetThetaResolution(modelResolution)
+  sphere.SetPhiResolution(modelResolution)
+  sphere.Update()
+  model = slicer.vtkMRMLModelNode()
+  model.SetName("model")
+  model.SetAndObservePolyData(sphere.GetOutput())
+  slicer.mrmlScene.AddNode(model)
+  saver = IncrementalSaveMixin()
+  tempDirectory = tempfile.mkdtemp(prefix="SliceTrackerBenchmark")
+  results = []
+  try:
+    for node, extension in [(targets, ".fcsv"), (model, ".vtk")]:
+      seconds = []
+      for _ in range(repetitions):
+        node.Modified()
+        with Timer() as timer:
+          saver.saveNodeDataIfModified(node, tempDirectory, extension)
+        seconds.append(timer.seconds)
+      results.append({
+        "extension": extension,
+        "points": node.GetNumberOfFiducials() if extension == ".fcsv" else node.GetPolyData().GetNumberOfPoints(),
+        "bytes": os.path.getsize(os.path.join(tempDirectory, node.GetName() + extension)),
+        "minimumSeconds": min(seconds),
+        "meanSeconds": sum(seconds) / len(seconds)
+      })
+  finally:
+    slicer.mrmlScene.RemoveNode(targets)
+    slicer.mrmlScene.RemoveNode(model)
+    shutil.rmtree(tempDirectory, ignore_errors=True)
+  return results
+
+
+def main(argv):
+  directory = None
+  outputFile = None
+  sizes = []
+  slicesPerSeries = 50
+  numberOfPatients = 1
+  compressionResults = 0
+  numberOfTargets = 0
+  try:
+    opts, args = getopt.getopt(argv, "d:o:s:c:w:", ["directory=", "output=", "sizes=", "slices=", "patients=",
+                                                    "compression=", "writes="])
+  except getopt.GetoptError:
+    print 'SliceTrackerBenchmarks.py -d <DICOM directory> -s <n,n,...> --slices <n> --patients <n> -c <n> -w <n> ' \
+          '-o <output.json>'
+    sys.exit(2)
+  for opt, arg in opts:
+    if opt in ("-d", "--directory"):
+      directory = arg
+    elif opt in ("-o", "--output"):
+      outputFile = arg
+    elif opt in ("-s", "--sizes"):
+      sizes = [int(size) for size in arg.split(",")]
+    elif opt == "--slices":
+      slicesPerSeries = int(arg)
+    elif opt == "--patients":
+      numberOfPatients = int(arg)
+    elif opt in ("-c", "--compression"):
+      compressionResults = int(arg)
+    elif opt in ("-w", "--writes"):
+      numberOfTargets = int(arg)
+
+  results = {}
+  if directory:
+    results["dicomHeaderReading"] = benchmarkDICOMHeaderReading(directory)
+  if sizes:
+    results["ingestion"] = [benchmarkIngestion(size, slicesPerSeries, numberOfPatients) for size in sizes]
+  if compressionResults:
+    results["compression"] = benchmarkCompression(compressionResults)
+  if numberOfTargets:
+    results["synchronousWrites"] = benchmarkSynchronousWrites(numberOfTargets)
+
+  output = json.dumps(results, indent=2)
+  print output
+  if outputFile:
+    with open(outputFile, 'w') as f:
+      f.write(output)
+
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
+  slicer.app.exit(0)
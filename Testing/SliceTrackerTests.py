@@ -1,9 +1,19 @@
 import unittest
-import os, inspect, slicer
+import os, inspect, slicer, vtk
+import shutil, tempfile, json
+import time
+from SlicerDevelopmentToolboxUtils.constants import FileExtension
 from SliceTrackerUtils.session import SliceTrackerSession
-from SliceTrackerUtils.sessionData import SessionData
+from SliceTrackerUtils.sessionData import SessionData, Volumes, IncrementalSaveMixin
+from SliceTrackerUtils.snapshotWriter import SnapshotWriter
+from SliceTrackerUtils.resultsJournal import ResultsJournal
+from SliceTrackerUtils.dicomHeaderIndex import DICOMHeaderIndex, DICOMHeaderRecord
+from SliceTrackerUtils.helpers import SeriesRegistry
+from SliceTrackerUtils.watch import SendStateStore, DICOMDirectoryObserver
 
-__all__ = ['SliceTrackerSessionTests', 'RegistrationResultsTest']
+__all__ = ['SliceTrackerSessionTests', 'RegistrationResultsTest', 'IncrementalSaveTest', 'ContentAddressedDataTest',
+           'DICOMHeaderIndexTest', 'SeriesRegistryTest', 'ResultsJournalTest', 'SendStateStoreTest',
+           'DICOMDirectoryObserverRetryTest']
 
 tempDir =  os.path.join(slicer.app.temporaryPath, "SliceTrackerResults")
 
@@ -50,4 +60,334 @@ class RegistrationResultsTest(unittest.TestCase):
   def test_Writing_json(self):
     self.registrationResults.resumed = True
     self.registrationResults.completed = True
-    self.registrationResults.save(tempDir)
\ No newline at end of file
+    self.registrationResults.save(tempDir)
+
+
+
+class IncrementalSaveTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.saver = IncrementalSaveMixin()
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(4, 4, 2)
+    imageData.AllocateScalars(vtk.VTK_SHORT, 1)
+    imageData.GetPointData().GetScalars().Fill(1)
+    self.volume = slicer.vtkMRMLScalarVolumeNode()
+    self.volume.SetAndObserveImageData(imageData)
+    transformMatrix = vtk.vtkMatrix4x4()
+    transformMatrix.SetElement(0, 3, 10)
+    self.transform = slicer.vtkMRMLLinearTransformNode()
+    self.transform.SetMatrixTransformToParent(transformMatrix)
+    self.targets = slicer.vtkMRMLMarkupsFiducialNode()
+    self.targets.AddFiducial(1, 2, 3)
+    self.nodes = [(self.volume, "volume", FileExtension.NRRD), (self.transform, "transform", FileExtension.H5),
+                  (self.targets, "targets", FileExtension.FCSV)]
+    for node, name, _ in self.nodes:
+      node.SetName(name)
+      slicer.mrmlScene.AddNode(node)
+
+  def tearDown(self):
+    for node, _, _ in self.nodes:
+      slicer.mrmlScene.RemoveNode(node)
+    shutil.rmtree(self.directory)
+
+  def runTest(self):
+    self.test_Unmodified_data_is_not_rewritten()
+
+  def save(self):
+    for node, _, extension in self.nodes:
+      self.assertTrue(self.saver.saveNodeDataIfModified(node, self.directory, extension)[0])
+    self.assertEqual(SnapshotWriter().flush(), [])
+    fileNames = [os.path.join(self.directory, name + extension) for _, name, extension in self.nodes]
+    modifiedTimes = {}
+    for fileName in fileNames:
+      self.assertTrue(os.path.exists(fileName))
+      modifiedTimes[fileName] = os.path.getmtime(fileName)
+      # set back so that a rewrite is detected regardless of the file system timestamp resolution
+      os.utime(fileName, (1000000000, 1000000000))
+    return modifiedTimes
+
+  def test_Unmodified_data_is_not_rewritten(self):
+    self.save()
+    modifiedTimes = self.save()
+    self.assertEqual(set(modifiedTimes.values()), {1000000000})
+    self.volume.GetImageData().GetPointData().GetScalars().Fill(2)
+    self.volume.GetImageData().Modified()
+    modifiedTimes = self.save()
+    volumeFileName = os.path.join(self.directory, "volume" + FileExtension.NRRD)
+    self.assertNotEqual(modifiedTimes.pop(volumeFileName), 1000000000)
+    self.assertEqual(set(modifiedTimes.values()), {1000000000})
+
+
+class ContentAddressedDataTest(unittest.TestCase):
+
+  def createVolume(self, name, value):
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(4, 4, 2)
+    imageData.AllocateScalars(vtk.VTK_SHORT, 1)
+    imageData.GetPointData().GetScalars().Fill(value)
+    volume = slicer.vtkMRMLScalarVolumeNode()
+    volume.SetName(name)
+    volume.SetAndObserveImageData(imageData)
+    slicer.mrmlScene.AddNode(volume)
+    self.addCleanup(slicer.mrmlScene.RemoveNode, volume)
+    return volume
+
+  def runTest(self):
+    self.test_Identical_volumes_share_a_blob()
+
+  def test_Identical_volumes_share_a_blob(self):
+    volumes = Volumes()
+    volumes.fixed = self.createVolume("fixed", 1)
+    volumes.moving = self.createVolume("moving", 1)
+    volumes.rigid = self.createVolume("rigid", 2)
+    self.assertEqual(volumes.getFileName(volumes.fixed), volumes.getFileName(volumes.moving))
+    self.assertNotEqual(volumes.getFileName(volumes.fixed), volumes.getFileName(volumes.rigid))
+    directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, directory)
+    volumes.save(directory)
+    SnapshotWriter().flush()
+    blobs = [f for _, _, files in os.walk(os.path.join(directory, Volumes.BLOB_DIRECTORY)) for f in files]
+    self.assertEqual(len(blobs), 2)
+
+
+class DICOMHeaderIndexTest(unittest.TestCase):
+
+  class CountingHeaderIndex(DICOMHeaderIndex):
+
+    def __init__(self, headers):
+      self.headers = headers
+      self.readCount = 0
+      super(DICOMHeaderIndexTest.CountingHeaderIndex, self).__init__()
+
+    def readRecord(self, fileName):
+      self.readCount += 1
+      seriesNumber, seriesDescription = self.headers[fileName]
+      return DICOMHeaderRecord(fileName, seriesNumber, seriesDescription, patientID="1", patientName="Doe")
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    headers = {}
+    for fileName, header in [("a", ("2", "COVER PROSTATE")), ("b", ("2", "COVER PROSTATE")), ("c", ("5", "GUIDANCE"))]:
+      open(os.path.join(self.directory, fileName), 'w').close()
+      headers[os.path.join(self.directory, fileName)] = header
+    self.index = self.CountingHeaderIndex(headers)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def path(self, fileName):
+    return os.path.join(self.directory, fileName)
+
+  def runTest(self):
+    self.test_Files_are_read_once()
+    self.test_Series_assembly()
+    self.test_Remove_series()
+    self.test_Series_completion()
+
+  def test_Files_are_read_once(self):
+    for fileName in ["a", "b", "a", "c", "b"]:
+      self.index.addFile(self.path(fileName))
+    self.index.getRecord(self.path("a"))
+    self.assertEqual(self.index.readCount, 3)
+
+  def test_Series_assembly(self):
+    self.index.addFiles([self.path(f) for f in ["a", "c", "b"]])
+    self.assertEqual(self.index.getFilesForSeries("2: COVER PROSTATE"), [self.path("a"), self.path("b")])
+    self.assertEqual(self.index.getRecord(self.path("c")).series, "5: GUIDANCE")
+    self.assertEqual(self.index.getRecord(self.path("c")).seriesNumber, 5)
+
+  def test_Remove_series(self):
+    self.index.addFiles([self.path(f) for f in ["a", "b", "c"]])
+    self.index.removeSeries("2: COVER PROSTATE")
+    self.assertFalse(self.path("a") in self.index)
+    self.assertEqual(len(self.index), 1)
+
+  def test_Series_completion(self):
+    self.index.addFiles([self.path(f) for f in ["a", "b", "c"]])
+    self.assertFalse(self.index.isSeriesComplete("2: COVER PROSTATE", stableCountTimeout=60))
+    self.assertTrue(self.index.isSeriesComplete("2: COVER PROSTATE", stableCountTimeout=0))
+    self.assertFalse(self.index.isSeriesComplete("7: VIBE", stableCountTimeout=0))
+
+
+class SeriesRegistryTest(unittest.TestCase):
+
+  def setUp(self):
+    self.registry = SeriesRegistry()
+    for series in ["12: GUIDANCE", "3: COVER TEMPLATE", "7: COVER PROSTATE", "10: GUIDANCE"]:
+      self.registry.add(series)
+
+  def runTest(self):
+    self.test_Sorted_insert()
+    self.test_Lookup_by_number()
+    self.test_Records_before()
+    self.test_Remove()
+    self.test_Lookup_by_type()
+
+  def test_Sorted_insert(self):
+    self.assertEqual(list(self.registry), ["3: COVER TEMPLATE", "7: COVER PROSTATE", "10: GUIDANCE", "12: GUIDANCE"])
+    self.assertEqual(list(reversed(self.registry))[0], "12: GUIDANCE")
+    self.assertTrue("7: COVER PROSTATE" in self.registry)
+
+  def test_Lookup_by_number(self):
+    self.assertEqual(self.registry.getSeriesByNumber(10), ["10: GUIDANCE"])
+    self.assertEqual(self.registry.getSeriesByNumber(11), [])
+    self.assertEqual(self.registry.getRecord("12: GUIDANCE").description, "GUIDANCE")
+
+  def test_Records_before(self):
+    self.assertEqual([r.number for r in self.registry.getRecordsBefore(10)], [3, 7])
+
+  def test_Remove(self):
+    self.registry.remove("7: COVER PROSTATE")
+    self.assertEqual(len(self.registry), 3)
+    self.assertEqual(self.registry.getSeriesByNumber(7), [])
+    self.assertFalse("7: COVER PROSTATE" in self.registry)
+
+  def test_Lookup_by_type(self):
+    self.assertEqual(self.registry.getSeriesByType("GUIDANCE"), ["10: GUIDANCE", "12: GUIDANCE"])
+    self.assertEqual(self.registry.getMostRecentSeriesForTypeSubstring("COVER"), "7: COVER PROSTATE")
+    self.assertIsNone(self.registry.getMostRecentSeriesForTypeSubstring("VIBE"))
+
+
+class ImmediateWriter(object):
+
+  def enqueue(self, fileName, function, arguments, onFailure=None):
+    function(*arguments)
+
+
+class ResultsJournalTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def runTest(self):
+    self.test_Torn_last_line_is_ignored()
+    self.test_Replay_is_idempotent()
+    self.test_Compaction()
+
+  def createJournal(self, name):
+    journal = ResultsJournal(os.path.join(self.directory, name + ".json"), ImmediateWriter())
+    journal.load()
+    return journal
+
+  @staticmethod
+  def createData(*names):
+    return {"results": [{"name": name, "status": "approved"} for name in names], "completed": False}
+
+  def test_Torn_last_line_is_ignored(self):
+    journal = self.createJournal("torn")
+    journal.write(self.createData("1: T2"))
+    with open(journal.journalFile, 'a') as f:
+      f.write('{"results": [{"name": "2: T2"')
+    self.assertEqual(ResultsJournal.read(journal.resultsFile), self.createData("1: T2"))
+    journal = self.createJournal("torn")
+    journal.write(self.createData("1: T2", "2: T2"))
+    self.assertFalse(os.path.getsize(journal.journalFile))
+    self.assertEqual(ResultsJournal.read(journal.resultsFile), self.createData("1: T2", "2: T2"))
+
+  def test_Replay_is_idempotent(self):
+    journal = self.createJournal("replay")
+    journal.write(self.createData("1: T2"), compact=True)
+    journal.write(self.createData("1: T2", "2: T2"))
+    with open(journal.journalFile) as f:
+      entries = f.read()
+    with open(journal.journalFile, 'a') as f:
+      f.write(entries)
+    self.assertEqual(ResultsJournal.read(journal.resultsFile), self.createData("1: T2", "2: T2"))
+
+  def test_Compaction(self):
+    journal = self.createJournal("compaction")
+    names = []
+    for index in range(1, ResultsJournal.COMPACTION_INTERVAL + 1):
+      names.append("%d: T2" % index)
+      journal.write(self.createData(*names))
+    self.assertFalse(os.path.getsize(journal.journalFile))
+    self.assertFalse(os.path.exists(journal.resultsFile + ".partial"))
+    with open(journal.resultsFile) as f:
+      self.assertEqual(json.load(f), self.createData(*names))
+
+
+class SendStateStoreTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.databaseFile = os.path.join(self.directory, ".state.db")
+    self.fileName = os.path.join(self.directory, "a.dcm")
+    with open(self.fileName, 'w') as f:
+      f.write("a")
+    self.state = SendStateStore(self.databaseFile)
+
+  def tearDown(self):
+    self.state.close()
+    shutil.rmtree(self.directory)
+
+  def reopen(self):
+    self.state.close()
+    self.state = SendStateStore(self.databaseFile)
+
+  def runTest(self):
+    self.test_Sent_files_persist()
+    self.test_Failed_files_back_off()
+
+  def test_Sent_files_persist(self):
+    self.state.markSent([self.fileName])
+    self.reopen()
+    self.assertTrue(self.state.isSent(self.fileName))
+    with open(self.fileName, 'a') as f:
+      f.write("b")
+    self.assertFalse(self.state.isSent(self.fileName))
+
+  def test_Failed_files_back_off(self):
+    now = time.time()
+    self.state.markFailed([self.fileName])
+    self.state.markFailed([self.fileName])
+    self.reopen()
+    self.assertEqual(self.state.getFailedFiles(), [self.fileName])
+    self.assertEqual(self.state.getFilesToRetry(now + SendStateStore.RETRY_BASE_DELAY), [])
+    self.assertEqual(self.state.getFilesToRetry(now + 2 * SendStateStore.RETRY_BASE_DELAY + 1), [self.fileName])
+    for _ in range(10):
+      self.state.markFailed([self.fileName])
+    self.assertEqual(self.state.getFilesToRetry(time.time() + SendStateStore.RETRY_MAXIMUM_DELAY + 1),
+                     [self.fileName])
+
+
+class DICOMDirectoryObserverRetryTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.fileName = os.path.join(self.directory, "a.dcm")
+    open(self.fileName, 'w').close()
+    self.commands = []
+    self.exitCodes = [1, 0]
+    self.observer = DICOMDirectoryObserver(self.directory, "localhost", "11112", numberOfAssociations=1,
+                                           runner=self.runStoreSCU)
+
+  def tearDown(self):
+    self.observer.state.close()
+    shutil.rmtree(self.directory)
+
+  def runStoreSCU(self, command):
+    self.commands.append(command)
+    return self.exitCodes.pop(0)
+
+  def runTest(self):
+    self.test_Failed_files_are_retried_until_sent()
+
+  def test_Failed_files_are_retried_until_sent(self):
+    self.observer.sendFiles([self.fileName])
+    self.observer.flush()
+    self.assertFalse(self.observer.state.isSent(self.fileName))
+    self.observer.retryFailedFiles()
+    self.assertEqual(len(self.commands), 1)
+    self.observer.state.RETRY_BASE_DELAY = 0
+    self.observer.state.markFailed([self.fileName])
+    self.observer.retryFailedFiles()
+    self.observer.flush()
+    self.assertEqual(len(self.commands), 2)
+    self.assertEqual(self.commands[-1][-1], self.fileName)
+    self.assertTrue(self.observer.state.isSent(self.fileName))
+    self.assertEqual(self.observer.state.getFailedFiles(), [])